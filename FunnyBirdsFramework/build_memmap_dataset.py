@@ -0,0 +1,26 @@
+import os
+import argparse
+
+from datasets.funny_birds import FunnyBirds
+from datasets.funny_birds_memmap import write_memmap_dataset
+
+parser = argparse.ArgumentParser(description='FunnyBirds - Memory-Mapped Dataset Cache')
+parser.add_argument('--data', metavar='DIR', required=True,
+                    help='path to dataset')
+parser.add_argument('--out', metavar='DIR', required=True,
+                    help='directory the cache is written to, one subdirectory per split')
+parser.add_argument('--modes', default=['train', 'test'], nargs='+', choices=['train', 'test'],
+                    help='dataset splits to convert')
+parser.add_argument('--workers', default=4, type=int,
+                    help='data loading worker processes decoding the PNGs')
+
+
+def main():
+    args = parser.parse_args()
+    for mode in args.modes:
+        dataset = FunnyBirds(args.data, mode, get_part_map=True, transform=None)
+        write_memmap_dataset(dataset, os.path.join(args.out, mode), num_workers=args.workers)
+        print('Wrote {} {} samples to {}'.format(len(dataset), mode, os.path.join(args.out, mode)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import os
+import re
+import sys
+import argparse
+import tomllib
+import torch
+
+with open("../model_selection.toml", "rb") as f:
+    PATHS = tomllib.load(f)['paths']
+
+sys.path.insert(0, PATHS['ppnet_dir'])
+
+from models.ppnet import load_proto_bound_boxes
+from ProtoPNet.checkpoint_funnybirds_multitarget import load_ppnet
+from ProtoPNet.bundle_funnybirds_multitarget import save_model_bundle
+
+parser = argparse.ArgumentParser(description='FunnyBirds - ProtoPNet Model Bundle')
+parser.add_argument('--model_path', default=PATHS['model_path'], type=str,
+                    help='ProtoPNet checkpoint (default: model_path of model_selection.toml)')
+parser.add_argument('--img_dir', default=PATHS['img_dir'], type=str,
+                    help='push output holding the bb tables (default: img_dir of model_selection.toml)')
+parser.add_argument('--out', required=True, type=str,
+                    help='bundle file to write')
+parser.add_argument('--base_architecture', default=None, type=str,
+                    help='backbone of checkpoints pickled as whole models, which do not record it')
+parser.add_argument('--add_on_layers_type', default='regular', type=str,
+                    help='add-on layers of checkpoints pickled as whole models')
+
+
+def main():
+    args = parser.parse_args()
+    checkpoint = torch.load(args.model_path, map_location='cpu', weights_only=False)
+    ppnet = load_ppnet(args.model_path, map_location='cpu')
+    if isinstance(checkpoint, dict):
+        arch = checkpoint['arch']
+    else:
+        if args.base_architecture is None:
+            parser.error('--base_architecture is required for whole-model checkpoints')
+        arch = dict(base_architecture=args.base_architecture, img_size=ppnet.img_size,
+                    prototype_shape=tuple(ppnet.prototype_shape), num_classes=ppnet.num_classes,
+                    prototype_activation_function=ppnet.prototype_activation_function,
+                    add_on_layers_type=args.add_on_layers_type)
+    proto_bound_boxes = load_proto_bound_boxes(args.model_path, args.img_dir)
+    epoch = int(re.search(r"\d+", os.path.basename(args.model_path)).group(0))
+    save_model_bundle(args.out, ppnet, arch, proto_bound_boxes, epoch=epoch)
+    print('Wrote {} prototypes of {} to {}'.format(len(proto_bound_boxes), args.model_path, args.out))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+import argparse
+
+from datasets.funny_birds import FunnyBirds
+from explainers.part_mask_store import write_part_mask_store
+
+parser = argparse.ArgumentParser(description='FunnyBirds - Part Mask Store')
+parser.add_argument('--data', metavar='DIR', required=True,
+                    help='path to dataset')
+parser.add_argument('--mode', default='test', choices=['train', 'test'],
+                    help='dataset split')
+parser.add_argument('--out', metavar='DIR', required=True,
+                    help='directory the store is written to')
+parser.add_argument('--device', default='cpu', type=str,
+                    help='device used for colour matching and dilation')
+
+
+def main():
+    args = parser.parse_args()
+    dataset = FunnyBirds(args.data, args.mode, get_part_map=True, transform=None)
+    write_part_mask_store(dataset, args.out, device=args.device)
+    print('Wrote part masks of {} samples to {}'.format(len(dataset), args.out))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import os
+import json
+import pickle
+import numpy as np
+import torch
+import torch.utils.data
+
+from .funny_birds import FunnyBirds
+
+
+def _as_list(samples):
+    return samples
+
+
+def write_memmap_dataset(dataset, cache_dir, num_workers = 4):
+    """
+    Decodes every sample of a FunnyBirds dataset once and writes
+    images.npy ([N, 3, H, W] uint8), part_maps.npy (if the dataset has get_part_map=True),
+    class_idx.npy, params.pkl and index.json to cache_dir
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=50, shuffle=False, num_workers=num_workers,
+                                         collate_fn=_as_list)
+    n_samples = len(dataset)
+    images = part_maps = None
+    class_idx = np.zeros(n_samples, dtype=np.int64)
+    params = []
+    start = 0
+    for samples in loader:
+        for i, sample in enumerate(samples, start):
+            if images is None:
+                shape = tuple(sample['image'].shape)
+                images = np.lib.format.open_memmap(os.path.join(cache_dir, 'images.npy'), mode='w+',
+                                                   dtype=np.uint8, shape=(n_samples,) + shape)
+                if 'part_map' in sample:
+                    part_maps = np.lib.format.open_memmap(os.path.join(cache_dir, 'part_maps.npy'), mode='w+',
+                                                          dtype=np.uint8, shape=(n_samples,) + tuple(sample['part_map'].shape))
+            images[i] = (sample['image'] * 255).round().clamp(0, 255).to(torch.uint8).numpy()
+            if part_maps is not None:
+                part_maps[i] = torch.as_tensor(sample['part_map']).round().clamp(0, 255).to(torch.uint8).numpy()
+            class_idx[i] = int(sample['class_idx'])
+            params.append(sample['params'])
+        start += len(samples)
+
+    images.flush()
+    if part_maps is not None:
+        part_maps.flush()
+    np.save(os.path.join(cache_dir, 'class_idx.npy'), class_idx)
+    with open(os.path.join(cache_dir, 'params.pkl'), 'wb') as f:
+        pickle.dump(params, f)
+    with open(os.path.join(cache_dir, 'index.json'), 'w') as f:
+        json.dump({'n_samples': n_samples, 'image_shape': list(images.shape[1:]),
+                   'part_maps': part_maps is not None}, f)
+
+
+class FunnyBirdsMemmap(FunnyBirds):
+    def __init__(self, root, mode, cache_dir, get_part_map=False, transform=None, uint8=False):
+        """
+        FunnyBirds read from the memory-mapped arrays written by build_memmap_dataset.py instead of PNGs.
+        Concurrent jobs share the arrays through the page cache.
+        Args:
+            cache_dir: directory of the converted split (<out>/<mode>)
+            uint8: return images (and part maps) as uint8 tensors, to be converted on the device;
+                   otherwise images are float in [0, 1] and part maps float in [0, 255] like FunnyBirds
+        """
+        super().__init__(root, mode, get_part_map=get_part_map, transform=transform)
+        with open(os.path.join(cache_dir, 'index.json')) as f:
+            index = json.load(f)
+        assert index['n_samples'] == len(self.params), 'memmap cache built for another dataset split'
+        assert index['part_maps'] or not get_part_map, 'memmap cache built without part maps'
+        self.uint8 = uint8
+        self.images = np.load(os.path.join(cache_dir, 'images.npy'), mmap_mode='r')
+        self.part_maps = np.load(os.path.join(cache_dir, 'part_maps.npy'), mmap_mode='r') if get_part_map else None
+        self.class_idxs = np.load(os.path.join(cache_dir, 'class_idx.npy'))
+        with open(os.path.join(cache_dir, 'params.pkl'), 'rb') as f:
+            self.sample_params = pickle.load(f)
+
+    def __len__(self):
+        return len(self.class_idxs)
+
+    def __getitem__(self, idx):
+        # a plain copy out of the page cache, no decoding
+        image = torch.from_numpy(np.array(self.images[idx]))
+        if not self.uint8:
+            image = image.float() / 255
+        if self.transform is not None:
+            image = self.transform(image)
+        sample = {'image': image, 'class_idx': int(self.class_idxs[idx]), 'params': self.sample_params[idx]}
+        if self.part_maps is not None:
+            part_map = torch.from_numpy(np.array(self.part_maps[idx]))
+            sample['part_map'] = part_map if self.uint8 else part_map.float()
+        return sample
@@ -1,18 +1,29 @@
+import os
 import sys
+import pickle
 import argparse
+import tempfile
+import functools
 import random
+import numpy as np
 import torch
 import tomllib
 from captum.attr import IntegratedGradients, InputXGradient
 
+from datasets.funny_birds import FunnyBirds
+from datasets.funny_birds_memmap import FunnyBirdsMemmap
 from models.resnet import resnet50
 from models.vgg import vgg16
-from models.ppnet import ppnet_model_path, ppnetexplain
+from models.ppnet import load_proto_bound_boxes, ppnetexplain
 from models.model_wrapper import StandardModel, ProtoPNetWrapper
 from evaluation_protocols import accuracy_protocol, controlled_synthetic_data_check_protocol, single_deletion_protocol, preservation_check_protocol, deletion_check_protocol, target_sensitivity_protocol, distractibility_protocol, background_independence_protocol
 from explainers.explainer_wrapper import (CaptumAttributionExplainer, 
                                           SSMExplainer,
                                           SSMAttriblikePExplainer)
+from explainers.explanation_cache import ExplanationCache
+from explainers.part_mask_store import PartMaskStore
+from result_journal import ResultJournal
+from evaluation_stream import PrefetchStream
 
 # The lines below avoid the issue with loading a model not from a state dict in case of ProtoPNet
 # (https://stackoverflow.com/questions/42703500/how-do-i-save-a-trained-model-in-pytorch)
@@ -22,6 +33,9 @@ with open("../model_selection.toml", "rb") as f:
 
 sys.path.insert(0, PATHS['ppnet_dir'])
 
+from ProtoPNet.checkpoint_funnybirds_multitarget import load_ppnet
+from ProtoPNet.bundle_funnybirds_multitarget import ModelBundle
+
 parser = argparse.ArgumentParser(description='FunnyBirds - Explanation Evaluation')
 parser.add_argument('--data', metavar='DIR', required=True,
                     help='path to dataset (default: imagenet)')
@@ -34,15 +48,58 @@ parser.add_argument('--explainer', required=True,
                     help='explainer')
 parser.add_argument('--checkpoint_name', type=str, required=False, default=None,
                     help='checkpoint name (including dir)')
+parser.add_argument('--model_bundle', type=str, default=None,
+                    help='ProtoPNet bundle written by build_model_bundle.py; replaces model_path and img_dir of model_selection.toml')
 
 parser.add_argument('--gpu', default=0, type=int,
                     help='GPU id to use.')
+parser.add_argument('--device', type=str, default=None,
+                    help='device the model and explainer run on, e.g. cuda:1 (default: cuda:<gpu>); it also sets --gpu, '
+                         'which the protocols use. cpu only works without protocols, to prefetch explanations')
+parser.add_argument('--num_threads', type=int, default=None,
+                    help='number of intra-op CPU threads')
+parser.add_argument('--num_interop_threads', type=int, default=None,
+                    help='number of inter-op CPU threads')
+parser.add_argument('--bf16', default=False, action='store_true',
+                    help='run models and explainers under bfloat16 autocast')
+parser.add_argument('--num_workers', default=1, type=int,
+                    help='number of worker processes the protocols are sharded over')
+parser.add_argument('--devices', type=str, default=None,
+                    help='comma separated cuda devices assigned round-robin to the workers (default: --device)')
+parser.add_argument('--shard_dir', type=str, default=None,
+                    help='directory the workers write their partial results to (default: a temporary one)')
+parser.add_argument('--ssm_top_k', type=int, default=None,
+                    help='SSM explainers: only use the top k prototypes by activation x connection score')
+parser.add_argument('--ssm_mass_cutoff', type=float, default=None,
+                    help='SSM explainers: only use the largest prototypes making up this fraction of the activation x connection mass')
+parser.add_argument('--ssm_report_error', action='store_true',
+                    help='report the approximation error of the truncated SSM explanations against the full sum')
+parser.add_argument('--journal', type=str, default=None,
+                    help='SQLite journal of results; restarted runs skip journaled protocols')
+parser.add_argument('--journal_explanations', default=False, action='store_true',
+                    help='also journal every computed explanation, so that restarted protocols skip explained samples '
+                         '(about 1 MB per Captum explanation)')
+parser.add_argument('--from_journal', default=False, action='store_true',
+                    help='only recompute the final results from the journal, without running any model')
 parser.add_argument('--seed', default=0, type=int,
                     help='seed')
 parser.add_argument('--batch_size', default=32, type=int,
                     help='batch size for protocols that do not require custom BS such as accuracy')
 parser.add_argument('--nr_itrs', default=2501, type=int,
                     help='batch size for protocols that do not require custom BS such as accuracy')
+parser.add_argument('--explanation_cache_mb', default=512, type=int,
+                    help='memory budget of the explanation cache shared by the protocols (0 disables it)')
+parser.add_argument('--explanation_cache_dir', type=str, default=None,
+                    help='directory evicted explanations are spilled to; keys include the model, so it can be shared')
+parser.add_argument('--part_mask_store', type=str, default=None,
+                    help='part mask store of the test set written by build_part_mask_store.py; '
+                         'unmodified test part maps are found in it by content')
+parser.add_argument('--prefetch_explanations', default=False, action='store_true',
+                    help='fill the explanation cache with batched explanations of the test set before running the protocols')
+parser.add_argument('--prefetch_workers', default=4, type=int,
+                    help='data loading worker processes of the prefetching stream')
+parser.add_argument('--dataset_cache', default=None, type=str,
+                    help='memory-mapped dataset cache written by build_memmap_dataset.py, read by the prefetching stream')
                     
 parser.add_argument('--accuracy', default=False, action='store_true',
                     help='compute accuracy')
@@ -64,14 +121,21 @@ parser.add_argument('--background_independence', default=False, action='store_tr
 
 
 
-def main():
-    args = parser.parse_args()
-    device = 'cuda:' + str(args.gpu)
+# protocol flags in the order they are run; protocols are the unit of work of the sharded runner
+PROTOCOLS = ['accuracy', 'controlled_synthetic_data_check', 'target_sensitivity', 'single_deletion',
+             'preservation_check', 'deletion_check', 'distractibility', 'background_independence']
+
+
+@functools.lru_cache
+def model_bundle(path):
+    return ModelBundle(path)
+
+
+def ppnet_model_path(args):
+    return args.model_bundle if args.model_bundle is not None else PATHS['model_path']
 
-    random.seed(args.seed)
-    torch.manual_seed(args.seed)
 
-    # create model
+def build_model(args, device):
     if args.model == 'resnet50':
         model = resnet50(num_classes = 50)
         model = StandardModel(model)
@@ -79,9 +143,11 @@ def main():
         model = vgg16(num_classes = 50)
         model = StandardModel(model)
     elif args.model == 'ppnet':
-        ppnet = torch.load(ppnet_model_path)
-        model = ppnet.cuda()
-        model = ProtoPNetWrapper(model)
+        if args.model_bundle is not None:
+            ppnet = model_bundle(args.model_bundle).model(device)
+        else:
+            ppnet = load_ppnet(PATHS['model_path'], map_location=device)
+        model = ProtoPNetWrapper(ppnet)
     else:
         print('Model not implemented')
     
@@ -89,75 +155,253 @@ def main():
         model.load_state_dict(torch.load(args.checkpoint_name, map_location=torch.device('cpu'))['state_dict'])
     model = model.to(device)
     model.eval()
+    return model
+
+
+def ppnet_proto_bound_boxes(args):
+    if args.model_bundle is not None:
+        return model_bundle(args.model_bundle).proto_bound_boxes
+    return load_proto_bound_boxes(PATHS['model_path'], PATHS['img_dir'])
+
+
+def journal_run(args):
+    """(model checkpoint, explainer) key of the explanations of this evaluation in the journal"""
+    if args.model == 'ppnet':
+        model = os.path.abspath(ppnet_model_path(args))
+    else:
+        model = args.model + ':' + str(args.checkpoint_name)
+    explainer = args.explainer
+    if args.explainer.startswith('SSM') and (args.ssm_top_k is not None or args.ssm_mass_cutoff is not None):
+        explainer += ':top_k={}:mass_cutoff={}'.format(args.ssm_top_k, args.ssm_mass_cutoff)
+    if args.bf16:
+        explainer += ':bf16'
+    return (model, explainer)
+
+
+def protocol_run(args):
+    """Key of the protocol results of this evaluation in the journal: journal_run plus
+    every argument the protocols' results depend on, so that changing one of them reruns the protocols"""
+    model, explainer = journal_run(args)
+    settings = 'data={}:seed={}:nr_itrs={}:batch_size={}'.format(
+        os.path.abspath(args.data), args.seed, args.nr_itrs, args.batch_size)
+    return (model, explainer + '|' + settings)
+
+
+def ssm_truncation(args):
+    return dict(top_k=args.ssm_top_k, mass_cutoff=args.ssm_mass_cutoff,
+                track_approximation_error=args.ssm_report_error)
+
+
+def build_explainer(model, args, device, journal = None):
+    cache = None
+    if args.explanation_cache_mb > 0:
+        cache = ExplanationCache(max_bytes=args.explanation_cache_mb * 2**20, spill_dir=args.explanation_cache_dir,
+                                 journal=journal if args.journal_explanations else None,
+                                 run=journal_run(args), device=device)
+    mask_store = None
+    if args.part_mask_store is not None:
+        mask_store = PartMaskStore(args.part_mask_store)
 
-    # create explainer
     if args.explainer == 'InputXGradient':
         explainer = InputXGradient(model)
-        explainer = CaptumAttributionExplainer(explainer)
+        explainer = CaptumAttributionExplainer(explainer, cache=cache, mask_store=mask_store)
     elif args.explainer == 'IntegratedGradients':
         explainer = IntegratedGradients(model)
         baseline = torch.zeros((1,3,256,256)).to(device)
-        explainer = CaptumAttributionExplainer(explainer, baseline=baseline)
+        explainer = CaptumAttributionExplainer(explainer, baseline=baseline, cache=cache, mask_store=mask_store,
+                                               internal_batch_size=args.batch_size)
     elif args.explainer == 'SSMExplainer':
-        explainer = ppnetexplain(model)
-        explainer = SSMExplainer(explainer)
+        explainer = ppnetexplain(model, ppnet_proto_bound_boxes(args))
+        explainer = SSMExplainer(explainer, cache=cache, mask_store=mask_store, **ssm_truncation(args))
     elif args.explainer == 'SSMAttriblikePExplainer':
-        explainer = ppnetexplain(model)
-        explainer = SSMAttriblikePExplainer(explainer)
+        explainer = ppnetexplain(model, ppnet_proto_bound_boxes(args))
+        explainer = SSMAttriblikePExplainer(explainer, cache=cache, mask_store=mask_store, **ssm_truncation(args))
     else:
         print('Explainer not implemented')
+    return explainer
 
-    accuracy, csdc, pc, dc, distractibility, sd, ts = -1, -1, -1, -1, -1, -1, -1
 
-    if args.accuracy:
-        print('Computing accuracy...')
-        accuracy = accuracy_protocol(model, args)
-        accuracy = round(accuracy, 5)
+def seed_everything(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
 
-    if args.controlled_synthetic_data_check:
-        print('Computing controlled synthetic data check...')
-        csdc = controlled_synthetic_data_check_protocol(model, explainer, args)
 
-    if args.target_sensitivity:
+def run_protocol(protocol, model, explainer, args):
+    # every protocol starts from the same RNG state, whichever protocols ran (or were skipped) before it
+    # in this process, so sharded and resumed runs draw the same numbers as a sequential run
+    seed_everything(args.seed)
+    if protocol == 'accuracy':
+        print('Computing accuracy...')
+        return round(accuracy_protocol(model, args), 5)
+    if protocol == 'controlled_synthetic_data_check':
+        print('Computing controlled synthetic data check...')
+        return controlled_synthetic_data_check_protocol(model, explainer, args)
+    if protocol == 'target_sensitivity':
         print('Computing target sensitivity...')
-        ts = target_sensitivity_protocol(model, explainer, args)
-        ts = round(ts, 5)
-
-    if args.single_deletion:
+        return round(target_sensitivity_protocol(model, explainer, args), 5)
+    if protocol == 'single_deletion':
         print('Computing single deletion...')
-        sd = single_deletion_protocol(model, explainer, args)
-        sd = round(sd, 5)
-
-    if args.preservation_check:
+        return round(single_deletion_protocol(model, explainer, args), 5)
+    if protocol == 'preservation_check':
         print('Computing preservation check...')
-        pc = preservation_check_protocol(model, explainer, args)
-
-    if args.deletion_check:
+        return preservation_check_protocol(model, explainer, args)
+    if protocol == 'deletion_check':
         print('Computing deletion check...')
-        dc = deletion_check_protocol(model, explainer, args)
-
-    if args.distractibility:
+        return deletion_check_protocol(model, explainer, args)
+    if protocol == 'distractibility':
         print('Computing distractibility...')
-        distractibility = distractibility_protocol(model, explainer, args)
-
-    if args.background_independence:
+        return distractibility_protocol(model, explainer, args)
+    if protocol == 'background_independence':
         print('Computing background independence...')
-        background_independence = background_independence_protocol(model, args)
-        background_independence = round(background_independence, 5)
-    
+        return round(background_independence_protocol(model, args), 5)
+
+
+def prefetch_explanations(explainer, args, device):
+    """Explains the unmodified test images in batches streamed ahead of the explainer, so that the
+    protocols find them in the explanation cache instead of explaining them one at a time"""
+    if args.dataset_cache is not None:
+        dataset = FunnyBirdsMemmap(args.data, 'test', os.path.join(args.dataset_cache, 'test'), get_part_map=True)
+    else:
+        dataset = FunnyBirds(args.data, 'test', get_part_map=True, transform=None)
+    stream = PrefetchStream(dataset, args.batch_size, device, num_workers=args.prefetch_workers)
+    print('Prefetching explanations of {} test images...'.format(len(dataset)))
+    for images, part_maps, params, targets in stream:
+        explainer.cached_explain_batch(images, target=targets)
+
+
+def run_protocols(protocols, args, device):
+    """Loads the model and explainer once and runs the given protocols on device"""
+    seed_everything(args.seed)
+
+    journal = None
+    results = {}
+    if args.journal is not None:
+        journal = ResultJournal(args.journal)
+        journaled = journal.protocol_results(protocol_run(args))
+        results = {protocol: journaled[protocol] for protocol in protocols if protocol in journaled}
+        for protocol in results:
+            print('Reusing journaled {}...'.format(protocol))
+        protocols = [protocol for protocol in protocols if protocol not in results]
+        # without protocols, a run can still prefetch explanations into the journal
+        if not protocols and not (args.prefetch_explanations and args.journal_explanations):
+            return results
+
+    model = build_model(args, device)
+    explainer = build_explainer(model, args, device, journal)
+
+    precision = torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=args.bf16)
+    with precision:
+        if args.prefetch_explanations and explainer.cache is not None:
+            prefetch_explanations(explainer, args, device)
+        for protocol in protocols:
+            results[protocol] = run_protocol(protocol, model, explainer, args)
+            if journal is not None:
+                journal.record_protocol_result(protocol_run(args), protocol, results[protocol])
+    if journal is not None:
+        journal.flush()
+
+    if explainer.cache is not None:
+        print('Explanation cache hits/misses: {}/{}'.format(explainer.cache.hits, explainer.cache.misses))
+    if hasattr(explainer, 'approximation_error') and explainer.approximation_error() is not None:
+        print('Mean relative L1 error of the truncated explanations: {:.5f}'.format(explainer.approximation_error()))
+    return results
+
+
+def use_device(args, device):
+    """Points args at device. The upstream protocols only know args.gpu and place their batches
+    on cuda:<args.gpu>, so it is set to the index of a cuda device"""
+    args.device = device
+    device = torch.device(device)
+    if device.type == 'cuda':
+        args.gpu = device.index if device.index is not None else 0
+        torch.cuda.set_device(args.gpu)
+
+
+def shard_worker(rank, shards, devices, args, shard_dir):
+    device = devices[rank % len(devices)]
+    use_device(args, device)
+    # spawned workers are fresh interpreters, which do not inherit the thread settings of main
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    if args.num_interop_threads is not None:
+        torch.set_num_interop_threads(args.num_interop_threads)
+    results = run_protocols(shards[rank], args, device)
+    with open(os.path.join(shard_dir, 'shard' + str(rank) + '.pkl'), 'wb') as f:
+        pickle.dump(results, f)
+
+
+def run_sharded(protocols, args):
+    """Splits the protocols over args.num_workers processes spread over args.devices and merges their results"""
+    devices = args.devices.split(',') if args.devices is not None else [args.device]
+    n_workers = min(args.num_workers, len(protocols))
+    shards = [protocols[rank::n_workers] for rank in range(n_workers)]
+    shard_dir = args.shard_dir if args.shard_dir is not None else tempfile.mkdtemp(prefix='funnybirds_shards_')
+    os.makedirs(shard_dir, exist_ok=True)
+
+    torch.multiprocessing.spawn(shard_worker, args=(shards, devices, args, shard_dir), nprocs=n_workers)
+
+    results = {}
+    for rank in range(n_workers):
+        with open(os.path.join(shard_dir, 'shard' + str(rank) + '.pkl'), 'rb') as f:
+            results.update(pickle.load(f))
+    return results
+
+
+def print_final_results(results):
+    accuracy, csdc, pc, dc, distractibility, background_independence, sd, ts = (
+        results.get(protocol, -1) for protocol in ['accuracy', 'controlled_synthetic_data_check', 'preservation_check',
+                                                   'deletion_check', 'distractibility', 'background_independence',
+                                                   'single_deletion', 'target_sensitivity'])
+
     # select completeness and distractability thresholds such that they maximize the sum of both
     max_score = 0
     best_threshold = -1
-    for threshold in csdc.keys():
-        max_score_tmp = csdc[threshold]/3. + pc[threshold]/3. + dc[threshold]/3. + distractibility[threshold]
-        if max_score_tmp > max_score:
-            max_score = max_score_tmp
-            best_threshold = threshold
+    thresholded = [csdc, pc, dc, distractibility]
+    if all(isinstance(result, dict) for result in thresholded):
+        for threshold in csdc.keys():
+            max_score_tmp = csdc[threshold]/3. + pc[threshold]/3. + dc[threshold]/3. + distractibility[threshold]
+            if max_score_tmp > max_score:
+                max_score = max_score_tmp
+                best_threshold = threshold
+    # protocols that were not run are the int -1
+    csdc, pc, dc, distractibility = (round(result[best_threshold],5)
+                                     if isinstance(result, dict) and best_threshold in result else -1
+                                     for result in thresholded)
 
     print('FINAL RESULTS:')
     print('Accuracy, CSDC, PC, DC, Distractability, Background independence, SD, TS')
-    print('{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}'.format(accuracy, round(csdc[best_threshold],5), round(pc[best_threshold],5), round(dc[best_threshold],5), round(distractibility[best_threshold],5), background_independence, sd, ts))
+    print('{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}'.format(accuracy, csdc, pc, dc, distractibility, background_independence, sd, ts))
     print('Best threshold:', best_threshold)
 
+
+def main():
+    args = parser.parse_args()
+    if args.from_journal and args.journal is None:
+        parser.error('--from_journal requires --journal')
+    protocols = [protocol for protocol in PROTOCOLS if getattr(args, protocol)]
+    devices = [args.device] + (args.devices.split(',') if args.devices is not None else [])
+    if protocols and not args.from_journal and any(device is not None and torch.device(device).type != 'cuda'
+                                                   for device in devices):
+        # the upstream protocols move their batches to cuda:<args.gpu> whatever the device of the model
+        parser.error('the evaluation protocols only run on cuda devices; --device/--devices cpu can only '
+                     'prefetch explanations into the journal')
+    if args.device is None:
+        args.device = 'cuda:' + str(args.gpu)
+    use_device(args, args.device)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    if args.num_interop_threads is not None:
+        torch.set_num_interop_threads(args.num_interop_threads)
+
+    if args.from_journal:
+        results = ResultJournal(args.journal).protocol_results(protocol_run(args))
+    elif args.num_workers > 1:
+        results = run_sharded(protocols, args)
+    else:
+        results = run_protocols(protocols, args, args.device)
+
+    print_final_results(results)
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,76 @@
+import collections
+import torch
+import torch.utils.data
+
+
+def collate_samples(samples):
+    """Stacks images, part maps and targets of FunnyBirds samples; params stay a list of per-sample dicts"""
+    images = torch.stack([sample['image'] for sample in samples])
+    part_maps = torch.stack([sample['part_map'] for sample in samples]) if 'part_map' in samples[0] else None
+    params = [sample['params'] for sample in samples]
+    targets = torch.as_tensor([sample['class_idx'] for sample in samples])
+    return images, part_maps, params, targets
+
+
+class PrefetchStream():
+    def __init__(self, dataset, batch_size, device, num_workers = 4, prefetch_batches = 2):
+        """
+        Streams (image, part_map, params, target) batches of a dataset in order, ahead of their use:
+        DataLoader workers load and decode, pinned host batches are copied to the device on a side
+        CUDA stream, and up to prefetch_batches batches wait on the device.
+        Args:
+            dataset: FunnyBirds dataset (with get_part_map=True for part maps)
+            batch_size: samples per yielded batch
+            device: device the batches are delivered on
+            num_workers: DataLoader worker processes
+            prefetch_batches: batches copied to the device ahead of the one being consumed
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.num_workers = num_workers
+        self.prefetch_batches = prefetch_batches
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def loader(self):
+        return torch.utils.data.DataLoader(
+            self.dataset, batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers,
+            collate_fn=collate_samples, pin_memory=self.device.type == 'cuda')
+
+    def to_device(self, batch):
+        images, part_maps, params, targets = batch
+        images = images.to(self.device, non_blocking=True)
+        if part_maps is not None:
+            part_maps = part_maps.to(self.device, non_blocking=True)
+        return images, part_maps, params, targets.to(self.device, non_blocking=True)
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            # the workers already load ahead; the copy to the cpu is free
+            for batch in self.loader():
+                yield self.to_device(batch)
+            return
+
+        copy_stream = torch.cuda.Stream(self.device)
+        queue = collections.deque()
+        for batch in self.loader():
+            with torch.cuda.stream(copy_stream):
+                batch = self.to_device(batch)
+                copied = torch.cuda.Event()
+                copied.record(copy_stream)
+            queue.append((batch, copied))
+            if len(queue) > self.prefetch_batches:
+                yield self.ready(*queue.popleft())
+        while queue:
+            yield self.ready(*queue.popleft())
+
+    def ready(self, batch, copied):
+        """Makes the consuming stream wait for the copy of batch, and keeps its memory alive for it"""
+        consumer = torch.cuda.current_stream(self.device)
+        consumer.wait_event(copied)
+        for tensor in batch:
+            if isinstance(tensor, torch.Tensor):
+                tensor.record_stream(consumer)
+        return batch
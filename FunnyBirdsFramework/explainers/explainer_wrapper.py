@@ -1,23 +1,126 @@
 import torch
-import torch.nn as nn
 import numpy as np
 from abc import abstractmethod
 from captum.attr import LayerAttribution
 
+from explainers.explanation_cache import ExplanationCache
+from explainers.part_index import PartIndex
+from explainers.threshold_sweep import ImportantParts, importance_threshold_matrix
+
+def batch_targets(target, batch_size, device):
+    """Turns an int, a [1] or a [B] target into a [B] long tensor of per-sample targets"""
+    target = torch.as_tensor(target, device=device).reshape(-1).long()
+    if target.numel() == 1:
+        target = target.expand(batch_size)
+    return target
+
 class AbstractExplainer():
-    def __init__(self, explainer, baseline = None):
+    def __init__(self, explainer, baseline = None, cache = None, mask_store = None):
         """
         An abstract wrapper for explanations.
         Args:
             model: PyTorch neural network model
+            cache: optional ExplanationCache shared across the evaluation protocols
+            mask_store: optional PartMaskStore the dilated part masks are looked up in by sample id
         """
         self.explainer = explainer
         self.explainer_name = type(self.explainer).__name__
         self.baseline = baseline
+        self.cache = cache
+        self.mask_store = mask_store
+        self.part_indices = {}
 
     @abstractmethod
     def explain(self, input):
         return self.explainer.explain(self.model, input)
+
+    def cache_config(self):
+        baseline = None if self.baseline is None else ExplanationCache.tensor_digest(self.baseline)
+        return (type(self).__name__, self.explainer_name, baseline)
+
+    def sample_attribution(self, attributions, b):
+        """Attribution of sample b of a batched explanation, shaped as explain returns it for a single image"""
+        return attributions[b:b+1]
+
+    def cached_explain_batch(self, input, target=None):
+        """
+        Per-sample attributions of a [B, ...] input, memoized per sample in self.cache.
+        Samples missing from the cache are explained together in one explain_batch call.
+        Keys are the content of the sample, its target and cache_config.
+        """
+        target = batch_targets(target, input.shape[0], input.device)
+        if self.cache is None:
+            explained = self.explain_batch(input, target=target).detach()
+            return [self.sample_attribution(explained, b) for b in range(input.shape[0])]
+
+        config = self.cache_config()
+        keys = [self.cache.key(input[b:b+1], target[b], config) for b in range(input.shape[0])]
+        attributions = [self.cache.get(key) for key in keys]
+
+        missing = [b for b, attribution in enumerate(attributions) if attribution is None]
+        if missing:
+            missing_index = torch.tensor(missing, device=input.device)
+            explained = self.explain_batch(input[missing_index], target=target[missing_index]).detach()
+            for i, b in enumerate(missing):
+                # a copy, so that the cached entry does not keep the whole batch alive
+                attributions[b] = self.sample_attribution(explained, i).clone()
+                self.cache.put(keys[b], attributions[b])
+        return attributions
+
+    def part_index(self, colors_to_part, with_bg, device):
+        """PartIndex of colors_to_part, built once per colour set and device"""
+        key = (tuple(colors_to_part.items()), with_bg, str(device))
+        if key not in self.part_indices:
+            self.part_indices[key] = PartIndex(colors_to_part, with_bg=with_bg, device=device)
+        return self.part_indices[key]
+
+    def part_masks(self, part_map, part_index, sample_ids = None):
+        """[B, K, H, W] dilated part masks, read from the mask store for samples it holds.
+        The protocols pass no sample ids, so unmodified part maps are found in the store by content"""
+        if self.mask_store is not None:
+            if sample_ids is None:
+                sample_ids = self.mask_store.find_samples(part_map, part_index)
+            if sample_ids is not None:
+                return self.mask_store.dilated_masks(sample_ids, part_index)
+        return part_index.dilated_masks(part_map)
+
+    def get_part_importance_tensor(self, image, part_map, target, colors_to_part, with_bg = False, sample_ids = None):
+        """
+        Outputs a [B, N] tensor of part importances and the list of N part names indexing it.
+        The importance of a part is the attribution summed within its dilated part mask.
+        """
+        attribution = torch.stack(self.cached_explain_batch(image, target=target))
+        part_index = self.part_index(colors_to_part, with_bg, image.device)
+        masks = self.part_masks(part_map, part_index, sample_ids)
+        return part_index.part_importance(attribution, masks), part_index.names
+
+    # Batched variants of get_important_parts and get_part_importance.
+    # images, part_maps: [B, ...] batches; targets: one target per sample (or a single one for all)
+    # These defaults explain one sample at a time, so any explainer implementing the
+    # single-image methods supports them; explainers that can explain batches override them.
+    def get_important_parts_batch(self, images, part_maps, targets, colors_to_part, thresholds, with_bg = False, sample_ids = None):
+        """
+        Outputs the important parts of every sample, as returned by get_important_parts.
+        """
+        targets = batch_targets(targets, images.shape[0], images.device)
+        return [self.get_important_parts(images[b:b+1], part_maps[b:b+1], targets[b:b+1], colors_to_part, thresholds,
+                                         with_bg = with_bg, **self.sample_ids_kwargs(sample_ids, b))
+                for b in range(images.shape[0])]
+
+    def get_part_importance_batch(self, images, part_maps, targets, colors_to_part, with_bg = False, sample_ids = None):
+        """
+        Outputs the part importances of every sample, as returned by get_part_importance.
+        """
+        targets = batch_targets(targets, images.shape[0], images.device)
+        return [self.get_part_importance(images[b:b+1], part_maps[b:b+1], targets[b:b+1], colors_to_part,
+                                         with_bg = with_bg, **self.sample_ids_kwargs(sample_ids, b))
+                for b in range(images.shape[0])]
+
+    @staticmethod
+    def sample_ids_kwargs(sample_ids, b):
+        """sample_ids keyword of sample b, left out when unknown so that explainers with the
+        original single-image signatures (without sample_ids) keep working"""
+        return {} if sample_ids is None else {'sample_ids': sample_ids[b:b+1]}
     
     def get_p_thresholds(self):
         return np.linspace(0.01, 0.50, num=80)
@@ -28,6 +131,9 @@ class AbstractAttributionExplainer(AbstractExplainer):
     def explain(self, input):
         return self.explainer.explain(self.model, input)
 
+    def explain_batch(self, input, target=None):
+        return self.explain(input, target=target)
+
 
     # image: the input image
     # part map: the corresponding segmentation map where one color denotes one part
@@ -35,30 +141,29 @@ class AbstractAttributionExplainer(AbstractExplainer):
     # colors_to_part: a list that maps colors to parts
     # thresholds: the different thresholds to use to estimate which parts are important
     # with_bg: include the background parts in the computation
-    def get_important_parts(self, image, part_map, target, colors_to_part, thresholds, with_bg = False):
+    # sample_ids: optional dataset indices of the images, used to look up part masks in the mask store
+    def get_important_parts(self, image, part_map, target, colors_to_part, thresholds, with_bg = False, sample_ids = None):
         """
         Outputs parts of the bird that are important according to the explanation.
         This must be reimplemented for different explanation types.
         Output is of the form: ['beak', 'wing', 'tail']
         """
         assert image.shape[0] == 1 # B = 1
-        attribution = self.explain(image, target=target)
+        return self.get_important_parts_batch(image, part_map, target, colors_to_part, thresholds, with_bg = with_bg, sample_ids = sample_ids)[0]
+
+    def get_important_parts_batch(self, images, part_maps, targets, colors_to_part, thresholds, with_bg = False, sample_ids = None):
+        attribution = torch.stack(self.cached_explain_batch(images, target=targets))
         #m = nn.ReLU()
         #positive_attribution = m(attribution)
 
-        part_importances = self.get_part_importance(image, part_map, target, colors_to_part, with_bg = with_bg)
+        part_importances, part_names = self.get_part_importance_tensor(images, part_maps, targets, colors_to_part, with_bg = with_bg, sample_ids = sample_ids)
         #total_attribution_in_parts = 0
         #for key in part_importances.keys():
         #    total_attribution_in_parts += abs(part_importances[key])
 
-        important_parts_for_thresholds = []
-        for threshold in thresholds:
-            important_parts = []
-            for key in part_importances.keys():
-                if part_importances[key] > (attribution.sum() * threshold):
-                    important_parts.append(key)
-            important_parts_for_thresholds.append(important_parts)
-        return important_parts_for_thresholds
+        total_attribution = attribution.reshape(images.shape[0], -1).sum(dim=1)
+        important_parts = importance_threshold_matrix(part_importances, thresholds, scale = total_attribution)
+        return [ImportantParts(matrix, part_names) for matrix in important_parts]
 
 
 
@@ -67,50 +172,17 @@ class AbstractAttributionExplainer(AbstractExplainer):
     # target: the target class
     # colors_to_part: a list that maps colors to parts
     # with_bg: include the background parts in the computation
-    def get_part_importance(self, image, part_map, target, colors_to_part, with_bg = False):
+    # sample_ids: optional dataset indices of the images, used to look up part masks in the mask store
+    def get_part_importance(self, image, part_map, target, colors_to_part, with_bg = False, sample_ids = None):
         """
         Outputs part importances for each part.
         """
         assert image.shape[0] == 1 # B = 1
-        attribution = self.explain(image, target=target)
-        
-        part_importances = {}
-
-        dilation1 = nn.MaxPool2d(5, stride=1, padding=2)
-        for part_color in colors_to_part.keys():
-            torch_color = torch.zeros(1,3,1,1).to(image.device)
-            torch_color[0,0,0,0] = part_color[0]
-            torch_color[0,1,0,0] = part_color[1]
-            torch_color[0,2,0,0] = part_color[2]
-            color_available = torch.all(part_map == torch_color, dim = 1, keepdim=True).float()
-            
-            color_available_dilated = dilation1(color_available)
-            attribution_in_part = attribution * color_available_dilated
-            attribution_in_part = attribution_in_part.sum()
-
-            part_string = colors_to_part[part_color]
-            part_string = ''.join((x for x in part_string if x.isalpha()))
-            if part_string in part_importances.keys():
-                part_importances[part_string] += attribution_in_part.item()
-            else:
-                part_importances[part_string] = attribution_in_part.item()
-
-        if with_bg:
-            for i in range(50):
-                torch_color = torch.zeros(1,3,1,1).to(image.device)
-                torch_color[0,0,0,0] = 204
-                torch_color[0,1,0,0] = 204
-                torch_color[0,2,0,0] = 204+i
-                color_available = torch.all(part_map == torch_color, dim = 1, keepdim=True).float()
-                color_available_dilated = dilation1(color_available)
-
-                attribution_in_part = attribution * color_available_dilated
-                attribution_in_part = attribution_in_part.sum()
-                
-                bg_string = 'bg_' + str(i).zfill(3)
-                part_importances[bg_string] = attribution_in_part.item()
-
-        return part_importances
+        return self.get_part_importance_batch(image, part_map, target, colors_to_part, with_bg = with_bg, sample_ids = sample_ids)[0]
+
+    def get_part_importance_batch(self, images, part_maps, targets, colors_to_part, with_bg = False, sample_ids = None):
+        part_importances, part_names = self.get_part_importance_tensor(images, part_maps, targets, colors_to_part, with_bg = with_bg, sample_ids = sample_ids)
+        return [dict(zip(part_names, importances)) for importances in part_importances.tolist()]
 
     def get_p_thresholds(self):
         return np.linspace(0.01, 0.50, num=80)
@@ -121,22 +193,29 @@ class CaptumAttributionExplainer(AbstractAttributionExplainer):
     A wrapper for Captum attribution methods.
     Args:
         explainer: Captum explanation method
+        internal_batch_size: images per forward/backward pass of IntegratedGradients, whose
+                             n_steps interpolations of a batch would otherwise run at once
     """
+    def __init__(self, explainer, baseline = None, cache = None, mask_store = None, internal_batch_size = None):
+        super().__init__(explainer, baseline=baseline, cache=cache, mask_store=mask_store)
+        self.internal_batch_size = internal_batch_size
+
     def explain(self, input, target=None, baseline=None):
         if self.explainer_name == 'InputXGradient': 
             return self.explainer.attribute(input, target=target)
         elif self.explainer_name == 'IntegratedGradients':
-            return self.explainer.attribute(input, target=target, baselines=self.baseline, n_steps=50)
+            return self.explainer.attribute(input, target=target, baselines=self.baseline, n_steps=50,
+                                            internal_batch_size=self.internal_batch_size)
 
 class CustomExplainer(AbstractExplainer):
 
     def explain(self, input):
         return 0
     
-    def get_important_parts(self, image, part_map, target, colors_to_part, thresholds, with_bg = False):
+    def get_important_parts(self, image, part_map, target, colors_to_part, thresholds, with_bg = False, sample_ids = None):
         return 0
     
-    def get_part_importance(self, image, part_map, target, colors_to_part, with_bg = False):
+    def get_part_importance(self, image, part_map, target, colors_to_part, with_bg = False, sample_ids = None):
         return 0
 
     # if not inheriting from AbstractExplainer you need to add this function to your class as well
@@ -147,34 +226,126 @@ class CustomExplainer(AbstractExplainer):
 # Ours below
 
 
+def bbox_union_masks(bboxes, valid, img_size):
+    """[B, P, 4] boxes (lower_y, upper_y, lower_x, upper_x) -> [B, H, W] boolean union of the valid boxes"""
+    coords = torch.arange(img_size, device=bboxes.device)
+    lower_y, upper_y, lower_x, upper_x = bboxes.unbind(dim=-1)
+    in_y = (coords >= lower_y[..., None]) & (coords < upper_y[..., None])
+    in_x = (coords >= lower_x[..., None]) & (coords < upper_x[..., None])
+    in_box = in_y[..., :, None] & in_x[..., None, :] & valid[..., None, None]
+    return in_box.any(dim=1)
+
+
 class AbstractSSMExplainer(AbstractExplainer):
-    def explain(self, input, target=None):
-        """Returns an image composed of sum of bbox rectangles whose contents
+    def __init__(self, explainer, baseline = None, cache = None, mask_store = None,
+                 top_k = None, mass_cutoff = None, track_approximation_error = False):
+        """
+        Args:
+            top_k: if not None, only the top_k prototypes by |activation x connection score| are used
+            mass_cutoff: if not None, only the largest prototypes making up this fraction of the
+                         total |activation x connection score| mass are used
+            track_approximation_error: with top_k or mass_cutoff, also compute the full sum to measure
+                                       the relative L1 error of the truncated explanations
+        """
+        super().__init__(explainer, baseline=baseline, cache=cache, mask_store=mask_store)
+        self.top_k = top_k
+        self.mass_cutoff = mass_cutoff
+        self.track_approximation_error = track_approximation_error
+        self.approximation_error_sum = 0.0
+        self.n_approximated = 0
+
+    @property
+    def truncated(self):
+        return self.top_k is not None or self.mass_cutoff is not None
+
+    def cache_config(self):
+        return super().cache_config() + (self.top_k, self.mass_cutoff)
+
+    def attribute_batch(self, input, target=None):
+        return self.explainer.attribute_batch(
+            input, target=target, top_k=self.top_k, mass_cutoff=self.mass_cutoff
+        )
+
+    def explain_batch(self, input, target=None):
+        """Returns [B, H, W] images composed of sum of bbox rectangles whose contents
         are made up of products of prototypes' connection scores and similairty scores.
         The bbox is filled with its maximum similarity score"""
-        attribution = torch.zeros(
-            (self.explainer.img_size, self.explainer.img_size),
-            dtype=torch.float32,
-            device="cuda",
+        prototypes = self.attribute_batch(input, target=target)
+        explanation = torch.einsum(
+            "bphw,bp->bhw", prototypes.activation_maps, prototypes.connection_scores
         )
-        for _, activation_map, _, connection_score in self.explainer.attribute(
-            input, target=target
-        ):
-            activation_map = (
-                activation_map.cuda(0, non_blocking=True) * connection_score
+        if self.truncated and self.track_approximation_error:
+            full_prototypes = self.explainer.attribute_batch(input, target=target)
+            full_explanation = torch.einsum(
+                "bphw,bp->bhw", full_prototypes.activation_maps, full_prototypes.connection_scores
             )
-            attribution = torch.add(attribution, activation_map)
+            error = (full_explanation - explanation).abs().sum(dim=(1, 2)) / \
+                full_explanation.abs().sum(dim=(1, 2)).clamp(min=1e-12)
+            self.approximation_error_sum += error.sum().item()
+            self.n_approximated += error.numel()
+        return explanation
+
+    def approximation_error(self):
+        """Mean relative L1 error of the truncated explanations so far, None if not tracked"""
+        if self.n_approximated == 0:
+            return None
+        return self.approximation_error_sum / self.n_approximated
+
+    def explain(self, input, target=None):
+        return self.explain_batch(input, target=target)[0]
 
-        return attribution
+    def sample_attribution(self, attributions, b):
+        return attributions[b]
 
-    @abstractmethod
     def get_important_parts(
-        self, image, part_map, target, colors_to_part, thresholds, with_bg=False
+        self,
+        image,
+        part_map,
+        target,
+        colors_to_part,
+        thresholds,
+        with_bg=False,
+        sample_ids=None,
+    ):
+        """
+        Outputs parts of the bird that are important according to the explanation.
+        This must be reimplemented for different explanation types.
+        Output is of the form: ['beak', 'wing', 'tail']
+        """
+        assert image.shape[0] == 1  # B = 1
+        return self.get_important_parts_batch(
+            image,
+            part_map,
+            target,
+            colors_to_part,
+            thresholds,
+            with_bg=with_bg,
+            sample_ids=sample_ids,
+        )[0]
+
+    @abstractmethod
+    def get_important_parts_batch(
+        self,
+        images,
+        part_maps,
+        targets,
+        colors_to_part,
+        thresholds,
+        with_bg=False,
+        sample_ids=None,
     ):
         return 0
 
     def get_part_importance(
-        self, image, part_map, target, colors_to_part, with_bg=False
+        self, image, part_map, target, colors_to_part, with_bg=False, sample_ids=None
+    ):
+        assert image.shape[0] == 1  # B = 1
+        return self.get_part_importance_batch(
+            image, part_map, target, colors_to_part, with_bg=with_bg, sample_ids=sample_ids
+        )[0]
+
+    def get_part_importance_batch(
+        self, images, part_maps, targets, colors_to_part, with_bg=False, sample_ids=None
     ):
         """The importance score within the bounding box of a single prototype is
         the product of its similarity score and its class connection score.
@@ -182,167 +353,80 @@ class AbstractSSMExplainer(AbstractExplainer):
         The final part importance is estimated by
         summing the importance scores of each prototype belonging to the class of interest."""
 
-        assert image.shape[0] == 1  # B = 1
-
         # image composed of sum of bbox rectangles
-        attribution = self.explain(image, target=target)
-
-        # We don't yet trus where we find ourselves the attribution being palced
-        attribution.to(image.device)
-
-        part_importances = {}
-
-        dilation1 = nn.MaxPool2d(5, stride=1, padding=2)
-        for part_color in colors_to_part.keys():
-            torch_color = torch.zeros(1, 3, 1, 1).to(image.device)
-            torch_color[0, 0, 0, 0] = part_color[0]
-            torch_color[0, 1, 0, 0] = part_color[1]
-            torch_color[0, 2, 0, 0] = part_color[2]
-            color_available = torch.all(
-                part_map == torch_color, dim=1, keepdim=True
-            ).float()
-
-            color_available_dilated = dilation1(color_available)
-            attribution_in_part = attribution * color_available_dilated
-            attribution_in_part = attribution_in_part.sum()
-            # We should be now dividing by the sum of max of mask and attrib
-            # BUT NOT HERE
-            # attribution_in_part /= torch.fmax(attribution, color_available_dilated).sum()
-            # BUT NOT HERE
-
-            part_string = colors_to_part[part_color]
-            part_string = "".join((x for x in part_string if x.isalpha()))
-            if part_string in part_importances.keys():
-                part_importances[part_string] += attribution_in_part.item()
-            else:
-                part_importances[part_string] = attribution_in_part.item()
-
-        if with_bg:
-            for i in range(50):
-                torch_color = torch.zeros(1, 3, 1, 1).to(image.device)
-                torch_color[0, 0, 0, 0] = 204
-                torch_color[0, 1, 0, 0] = 204
-                torch_color[0, 2, 0, 0] = 204 + i
-                color_available = torch.all(
-                    part_map == torch_color, dim=1, keepdim=True
-                ).float()
-                color_available_dilated = dilation1(color_available)
-
-                attribution_in_part = attribution * color_available_dilated
-                attribution_in_part = attribution_in_part.sum()
-
-                bg_string = "bg_" + str(i).zfill(3)
-                part_importances[bg_string] = attribution_in_part.item()
-
-        return part_importances
+        part_importances, part_names = self.get_part_importance_tensor(
+            images, part_maps, targets, colors_to_part, with_bg=with_bg, sample_ids=sample_ids
+        )
+        # We should be now dividing by the sum of max of mask and attrib
+        # BUT NOT HERE
+        # attribution_in_part /= torch.fmax(attribution, color_available_dilated).sum()
+        # BUT NOT HERE
+
+        return [dict(zip(part_names, importances)) for importances in part_importances.tolist()]
 
 
 class SSMExplainer(AbstractSSMExplainer):
     # The original approach to calculate P for prototypes.
-    def get_important_parts(
-        self, image, part_map, target, colors_to_part, thresholds, with_bg=False
+    def get_important_parts_batch(
+        self,
+        images,
+        part_maps,
+        targets,
+        colors_to_part,
+        thresholds,
+        with_bg=False,
+        sample_ids=None,
     ):
-        """
-        Outputs parts of the bird that are important according to the explanation.
-        This must be reimplemented for different explanation types.
-        Output is of the form: ['beak', 'wing', 'tail']
-        """
-        assert image.shape[0] == 1  # B = 1
-
-        part_importances = {}
-
-        attribution = torch.zeros(
-            (self.explainer.img_size, self.explainer.img_size),
-            dtype=torch.float32,
-            device="cuda",
-        )
-        for bbox, _, _, _ in self.explainer.attribute(image, target=target):
-            lower_y, upper_y, lower_x, upper_x = bbox
-            attribution[lower_y:upper_y, lower_x:upper_x] = 1.0
+        prototypes = self.attribute_batch(images, target=targets)
+        attribution = bbox_union_masks(
+            prototypes.bboxes, prototypes.valid, self.explainer.img_size
+        ).float()
 
         # m = nn.ReLU()
         # positive_attribution = m(attribution)
-        dilation1 = nn.MaxPool2d(5, stride=1, padding=2)
-        for part_color in colors_to_part.keys():
-            torch_color = torch.zeros(1, 3, 1, 1).to(image.device)
-            torch_color[0, 0, 0, 0] = part_color[0]
-            torch_color[0, 1, 0, 0] = part_color[1]
-            torch_color[0, 2, 0, 0] = part_color[2]
-            color_available = torch.all(
-                part_map == torch_color, dim=1, keepdim=True
-            ).float()
-            color_available_dilated = dilation1(color_available)
-            attribution_in_part = attribution * color_available_dilated
-            attribution_in_part = attribution_in_part.sum()
-
-            # Averaging for Prototypes
-            attribution_in_part /= color_available_dilated.sum()
-
-            part_string = colors_to_part[part_color]
-            part_string = "".join((x for x in part_string if x.isalpha()))
-            part_importances[part_string] = attribution_in_part.item()
-
-        if with_bg:
-            for i in range(50):
-                torch_color = torch.zeros(1, 3, 1, 1).to(image.device)
-                torch_color[0, 0, 0, 0] = 204
-                torch_color[0, 1, 0, 0] = 204
-                torch_color[0, 2, 0, 0] = 204 + i
-                color_available = torch.all(
-                    part_map == torch_color, dim=1, keepdim=True
-                ).float()
-                color_available_dilated = dilation1(color_available)
-
-                attribution_in_part = attribution * color_available_dilated
-                attribution_in_part = attribution_in_part.sum()
-
-                # Averaging for Prototypes
-                attribution_in_part /= color_available_dilated.sum()
-
-                bg_string = "bg_" + str(i).zfill(3)
-                part_importances[bg_string] = attribution_in_part.item()
+        part_index = self.part_index(colors_to_part, with_bg, images.device)
+        masks = self.part_masks(part_maps, part_index, sample_ids)
+        attribution_in_parts = part_index.color_importance(attribution, masks)
+
+        # Averaging for Prototypes
+        attribution_in_parts /= masks.sum(dim=(2, 3))
+
+        # a part made of several colours takes the value of its last colour
+        part_importances = part_index.last_by_part(attribution_in_parts)
 
         # total_attribution_in_parts = 0
         # for key in part_importances.keys():
         #    total_attribution_in_parts += abs(part_importances[key])
 
-        important_parts_for_thresholds = []
-        for threshold in thresholds:
-            important_parts = []
-            for key in part_importances.keys():
-                if part_importances[key] > threshold:
-                    important_parts.append(key)
-            important_parts_for_thresholds.append(important_parts)
-        return important_parts_for_thresholds
+        important_parts = importance_threshold_matrix(part_importances, thresholds)
+        return [ImportantParts(matrix, part_index.names) for matrix in important_parts]
 
 
 class SSMAttriblikePExplainer(AbstractSSMExplainer):
     # Adaptation of approach for calculating P used in attribution maps (AbstractAttributionExplainer)
-    def get_important_parts(
-        self, image, part_map, target, colors_to_part, thresholds, with_bg=False
+    def get_important_parts_batch(
+        self,
+        images,
+        part_maps,
+        targets,
+        colors_to_part,
+        thresholds,
+        with_bg=False,
+        sample_ids=None,
     ):
-        """
-        Outputs parts of the bird that are important according to the explanation.
-        This must be reimplemented for different explanation types.
-        Output is of the form: ['beak', 'wing', 'tail']
-        """
-        assert image.shape[0] == 1  # B = 1
-        attribution = self.explain(image, target=target)
+        attribution = torch.stack(self.cached_explain_batch(images, target=targets))
         # m = nn.ReLU()
         # positive_attribution = m(attribution)
 
-        part_importances = self.get_part_importance(
-            image, part_map, target, colors_to_part, with_bg=with_bg
+        part_importances, part_names = self.get_part_importance_tensor(
+            images, part_maps, targets, colors_to_part, with_bg=with_bg, sample_ids=sample_ids
         )
         # total_attribution_in_parts = 0
         # for key in part_importances.keys():
         #    total_attribution_in_parts += abs(part_importances[key])
 
-        important_parts_for_thresholds = []
-        for threshold in thresholds:
-            important_parts = []
-            for key in part_importances.keys():
-                if part_importances[key] > (attribution.sum() * threshold):
-                    important_parts.append(key)
-            important_parts_for_thresholds.append(important_parts)
-        return important_parts_for_thresholds
\ No newline at end of file
+        total_attribution = attribution.reshape(images.shape[0], -1).sum(dim=1)
+        important_parts = importance_threshold_matrix(
+            part_importances, thresholds, scale=total_attribution
+        )
+        return [ImportantParts(matrix, part_names) for matrix in important_parts]
@@ -0,0 +1,82 @@
+import os
+import hashlib
+import collections
+import torch
+
+
+class ExplanationCache():
+    def __init__(self, max_bytes = 512 * 2**20, spill_dir = None, journal = None, run = None, device = None):
+        """
+        LRU cache of explanations shared by all evaluation protocols.
+        Args:
+            max_bytes: memory budget of the cached tensors
+            spill_dir: if not None, evicted explanations are written there and reloaded on demand
+            journal: optional ResultJournal every explanation is written through to, so restarted runs reuse them
+            run: (model, explainer) key of the run in the journal; it is part of every cache key, so that
+                 a spill_dir shared by several models never serves the explanations of another one
+            device: device spilled and journaled explanations are loaded onto, whichever device computed them
+        """
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.journal = journal
+        self.run = run
+        self.device = device
+        self.entries = collections.OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    @staticmethod
+    def tensor_digest(tensor):
+        digest = hashlib.sha1()
+        tensor = tensor.detach().contiguous()
+        digest.update(str((tuple(tensor.shape), tensor.dtype)).encode())
+        digest.update(tensor.reshape(-1).view(torch.uint8).cpu().numpy().tobytes())
+        return digest.hexdigest()
+
+    def key(self, input, target, config):
+        """Content hash of the input tensor plus target plus explainer config plus the run's model"""
+        if target is not None:
+            target = torch.as_tensor(target).reshape(-1).tolist()
+        digest = hashlib.sha1()
+        digest.update(ExplanationCache.tensor_digest(input).encode())
+        digest.update(str((target, config, self.run)).encode())
+        return digest.hexdigest()
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, key + '.pt')
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        explanation = None
+        if self.spill_dir is not None and os.path.exists(self._spill_path(key)):
+            explanation = torch.load(self._spill_path(key), map_location=self.device)
+        elif self.journal is not None:
+            explanation = self.journal.explanation(self.run, key, map_location=self.device)
+        if explanation is not None:
+            self._insert(key, explanation)
+            self.hits += 1
+            return explanation
+        self.misses += 1
+        return None
+
+    def put(self, key, explanation):
+        if self.journal is not None:
+            self.journal.record_explanation(self.run, key, explanation)
+        self._insert(key, explanation)
+
+    def _insert(self, key, explanation):
+        if key in self.entries:
+            self.n_bytes -= self.entries.pop(key).nbytes
+        self.entries[key] = explanation
+        self.n_bytes += explanation.nbytes
+        while self.n_bytes > self.max_bytes and self.entries:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            self.n_bytes -= evicted.nbytes
+            if self.spill_dir is not None and not os.path.exists(self._spill_path(evicted_key)):
+                torch.save(evicted, self._spill_path(evicted_key))
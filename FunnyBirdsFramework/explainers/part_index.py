@@ -0,0 +1,72 @@
+import torch
+import torch.nn.functional as F
+
+# background colours of FunnyBirds part maps: (204, 204, 204 + i) is background part bg_i
+BG_COLORS = [(204, 204, 204 + i) for i in range(50)]
+
+
+def part_name(part_string):
+    return ''.join((x for x in part_string if x.isalpha()))
+
+
+class PartIndex():
+    def __init__(self, colors_to_part, with_bg = False, device = 'cpu'):
+        """
+        Vectorized lookup of part colours.
+        Colour k of the index is mapped to the part names[color_to_name[k]]; colours that only
+        differ by digits (e.g. eye01, eye02) share a part name.
+        Args:
+            colors_to_part: a dict that maps colors to parts
+            with_bg: include the background parts
+            device: device the index lives on
+        """
+        colors = list(colors_to_part.keys())
+        color_names = [part_name(colors_to_part[color]) for color in colors]
+        if with_bg:
+            colors += BG_COLORS
+            color_names += ['bg_' + str(i).zfill(3) for i in range(len(BG_COLORS))]
+
+        self.colors = [tuple(int(c) for c in color) for color in colors]
+        self.names = list(dict.fromkeys(color_names))
+        self.n_colors = len(colors)
+        self.color_to_name = torch.tensor([self.names.index(name) for name in color_names], device=device)
+        # the last colour of every part, for explainers that overwrite rather than accumulate
+        self.last_color_of_name = torch.tensor(
+            [len(color_names) - 1 - color_names[::-1].index(name) for name in self.names], device=device)
+
+        codes = torch.tensor([(r << 16) | (g << 8) | b for r, g, b in self.colors], device=device)
+        self.sorted_codes, self.sorted_order = torch.sort(codes)
+
+    def label_map(self, part_map):
+        """[B, 3, H, W] part map in 0-255 -> [B, H, W] colour index, -1 where no colour matches"""
+        part_map = part_map.round().long()
+        codes = (part_map[:, 0] << 16) | (part_map[:, 1] << 8) | part_map[:, 2]
+        position = torch.searchsorted(self.sorted_codes, codes).clamp(max=self.n_colors - 1)
+        found = self.sorted_codes[position] == codes
+        return torch.where(found, self.sorted_order[position], -1)
+
+    def dilated_masks(self, part_map):
+        """[B, 3, H, W] part map -> [B, K, H, W] masks of all colours, dilated by a 5x5 max pool"""
+        labels = self.label_map(part_map)
+        color_ids = torch.arange(self.n_colors, device=labels.device)
+        masks = (labels[:, None] == color_ids[None, :, None, None]).float()
+        return F.max_pool2d(masks, 5, stride=1, padding=2)
+
+    def color_importance(self, attribution, masks):
+        """Attribution ([H, W], [B, H, W] or [B, C, H, W]) summed within each of the [B, K, H, W] masks"""
+        batch_size, _, height, width = masks.shape
+        attribution = attribution.reshape(batch_size, -1, height, width).sum(dim=1)
+        return torch.einsum('bhw,bkhw->bk', attribution.to(masks.dtype), masks)
+
+    def sum_by_part(self, color_values):
+        """[B, K] per-colour values -> [B, N] per-part sums"""
+        part_values = color_values.new_zeros(color_values.shape[0], len(self.names))
+        return part_values.index_add_(1, self.color_to_name, color_values)
+
+    def last_by_part(self, color_values):
+        """[B, K] per-colour values -> [B, N] value of the last colour of each part"""
+        return color_values[:, self.last_color_of_name]
+
+    def part_importance(self, attribution, masks):
+        """[B, N] attribution summed within the [B, K, H, W] dilated masks of every part"""
+        return self.sum_by_part(self.color_importance(attribution, masks))
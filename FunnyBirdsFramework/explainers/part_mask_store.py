@@ -0,0 +1,112 @@
+import os
+import json
+import numpy as np
+import torch
+import torch.utils.data
+
+from explainers.part_index import PartIndex
+
+NO_PART = 255
+# fixed pixel weights of the label map fingerprints, identical in numpy and torch
+FINGERPRINT_SEED = 0
+
+
+class PartMaskStore():
+    def __init__(self, store_dir):
+        """
+        Memory-mapped dilated part masks of a FunnyBirds split, written by build_part_mask_store.py.
+        Args:
+            store_dir: directory holding index.json, labels.npy and dilated_masks.npy
+        """
+        with open(os.path.join(store_dir, 'index.json')) as f:
+            index = json.load(f)
+        self.colors = [tuple(color) for color in index['colors']]
+        self.height, self.width = index['shape']
+        # [N, H, W] colour index, NO_PART where no colour matches
+        self.labels = np.load(os.path.join(store_dir, 'labels.npy'), mmap_mode='r')
+        # [N, K, ceil(H * W / 8)] bits of every dilated colour mask
+        self.packed_masks = np.load(os.path.join(store_dir, 'dilated_masks.npy'), mmap_mode='r')
+
+        # fingerprint -> sample id, to find the samples of part maps passed without their ids
+        weights = np.random.default_rng(FINGERPRINT_SEED).integers(0, 2**20, size=self.height * self.width)
+        self.fingerprint_weights = weights
+        self.sample_of_fingerprint = {}
+        for i in range(len(self)):
+            fingerprint = int(self.labels[i].reshape(-1).astype(np.int64) @ weights)
+            self.sample_of_fingerprint.setdefault(fingerprint, i)
+        # device -> (PartIndex of the store's colours, fingerprint weights)
+        self.lookup_tables = {}
+
+    def __len__(self):
+        return self.labels.shape[0]
+
+    def lookup_table(self, device):
+        key = str(device)
+        if key not in self.lookup_tables:
+            color_index = PartIndex({color: 'part' for color in self.colors}, device=device)
+            self.lookup_tables[key] = (color_index, torch.from_numpy(self.fingerprint_weights).to(device))
+        return self.lookup_tables[key]
+
+    def find_samples(self, part_map, part_index):
+        """
+        Sample ids of a [B, 3, H, W] part map batch, found by content, or None unless every part map
+        is exactly the one of a stored sample (e.g. when a protocol removed parts) and the store
+        holds the colours of part_index. A fingerprint match is confirmed by comparing the whole label map.
+        """
+        if tuple(part_map.shape[2:]) != (self.height, self.width) or \
+                self.colors[:part_index.n_colors] != part_index.colors:
+            return None
+        color_index, weights = self.lookup_table(part_map.device)
+        labels = color_index.label_map(part_map)
+        labels = labels.masked_fill(labels < 0, NO_PART)
+        fingerprints = (labels.reshape(labels.shape[0], -1) * weights).sum(dim=1).tolist()
+        sample_ids = [self.sample_of_fingerprint.get(fingerprint) for fingerprint in fingerprints]
+        if any(sample_id is None for sample_id in sample_ids):
+            return None
+        stored = torch.from_numpy(np.stack([self.labels[i] for i in sample_ids])).to(labels.device)
+        if not torch.equal(stored.long(), labels):
+            return None
+        return sample_ids
+
+    def dilated_masks(self, sample_ids, part_index):
+        """[B, K, H, W] dilated masks of the colours of part_index for the given sample ids"""
+        n_colors = part_index.n_colors
+        assert self.colors[:n_colors] == part_index.colors, 'part mask store built for other part colours'
+        device = part_index.sorted_codes.device
+
+        sample_ids = torch.as_tensor(sample_ids).reshape(-1).tolist()
+        packed = torch.from_numpy(np.stack([self.packed_masks[i, :n_colors] for i in sample_ids])).to(device)
+        shifts = torch.arange(7, -1, -1, device=device, dtype=torch.uint8)
+        bits = (packed[..., None] >> shifts) & 1
+        bits = bits.reshape(len(sample_ids), n_colors, -1)[..., :self.height * self.width]
+        return bits.reshape(len(sample_ids), n_colors, self.height, self.width).float()
+
+
+def write_part_mask_store(dataset, store_dir, batch_size = 50, device = 'cpu'):
+    """Writes the labels and dilated part masks of every sample of a FunnyBirds dataset loaded with get_part_map=True"""
+    os.makedirs(store_dir, exist_ok=True)
+    part_index = PartIndex(dataset.colors_to_part, with_bg=True, device=device)
+    assert part_index.n_colors < NO_PART
+
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=4)
+    labels = None
+    start = 0
+    for samples in loader:
+        part_maps = samples['part_map'].to(device)
+        batch_labels = part_index.label_map(part_maps)
+        masks = part_index.dilated_masks(part_maps) > 0
+        if labels is None:
+            n_samples, (height, width) = len(dataset), batch_labels.shape[1:]
+            labels = np.lib.format.open_memmap(os.path.join(store_dir, 'labels.npy'), mode='w+',
+                                               dtype=np.uint8, shape=(n_samples, height, width))
+            packed_masks = np.lib.format.open_memmap(os.path.join(store_dir, 'dilated_masks.npy'), mode='w+',
+                                                     dtype=np.uint8, shape=(n_samples, part_index.n_colors, (height * width + 7) // 8))
+        end = start + part_maps.shape[0]
+        labels[start:end] = batch_labels.masked_fill(batch_labels < 0, NO_PART).cpu().numpy().astype(np.uint8)
+        packed_masks[start:end] = np.packbits(masks.flatten(2).cpu().numpy(), axis=2)
+        start = end
+
+    labels.flush()
+    packed_masks.flush()
+    with open(os.path.join(store_dir, 'index.json'), 'w') as f:
+        json.dump({'colors': part_index.colors, 'names': part_index.names, 'shape': [height, width]}, f)
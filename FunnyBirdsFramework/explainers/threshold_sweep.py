@@ -0,0 +1,47 @@
+import collections.abc
+import torch
+
+
+def importance_threshold_matrix(importances, thresholds, scale = None):
+    """
+    Compares [..., K] part importances against all [T] thresholds in one broadcast op.
+    A part is important for a threshold if its importance exceeds threshold * scale,
+    or the threshold itself when scale is None. Returns a [..., T, K] boolean matrix.
+    """
+    if scale is None:
+        thresholds = torch.as_tensor(thresholds, dtype=torch.float64, device=importances.device)
+        return importances.double()[..., None, :] > thresholds[:, None]
+    scale = torch.as_tensor(scale, dtype=importances.dtype, device=importances.device)
+    thresholds = torch.as_tensor(thresholds, device=importances.device).to(importances.dtype)
+    return importances[..., None, :] > (scale[..., None] * thresholds)[..., None]
+
+
+class ImportantParts(collections.abc.Sequence):
+    def __init__(self, matrix, names):
+        """
+        Important parts for every threshold, as returned by get_important_parts.
+        Indexing yields the list of important part names of a threshold, e.g. ['beak', 'wing', 'tail'];
+        the lists are only built on first access. Consumers that can work on
+        the [T, K] boolean matrix should use it directly.
+        Args:
+            matrix: [T, K] boolean tensor, True where part k is important for threshold t
+            names: the K part names indexing the columns of the matrix
+        """
+        self.matrix = matrix
+        self.names = names
+        self._rows = None
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if self._rows is None:
+            self._rows = self.matrix.tolist()
+        return [name for name, important in zip(self.names, self._rows[index]) if important]
+
+    def count(self, part_names):
+        """[T] number of the given parts that are important for each threshold"""
+        columns = [k for k, name in enumerate(self.names) if name in part_names]
+        return self.matrix[:, columns].sum(dim=1)
@@ -1,6 +1,8 @@
 import torch.nn as nn
 from abc import abstractmethod
 
+from ProtoPNet.model_funnybirds_multitarget import forward_with_distances
+
 class ModelExplainerWrapper:
 
     def __init__(self, model, explainer):
@@ -58,4 +60,8 @@ class ProtoPNetWrapper(AbstractModel):
     # Overriding the output of model since it returns a tuple (logis and prototypes) of sizes
     # torch.Size([8, 50]) torch.Size([8, 500])
     def forward(self, input):
-        return self.model(input)[0]
\ No newline at end of file
+        return self.forward_with_distances(input)[0]
+
+    def forward_with_distances(self, input):
+        """Returns logits, min distances and full distance maps from one backbone pass"""
+        return forward_with_distances(self.model, input)
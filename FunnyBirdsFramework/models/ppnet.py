@@ -1,85 +1,194 @@
 import os
 import re
-import cv2
-import tomllib
+import collections
 import torch
 import torch.utils.data
 import numpy as np
 
-from ProtoPNet.helpers import find_high_activation_crop
-
-with open("../../model_selection.toml", "rb") as f:
-    PATHS = tomllib.load(f)['paths']
-
-load_model_path = PATHS["model_path"]
-load_img_dir = PATHS["img_dir"]
-
-load_model_name = os.path.basename(load_model_path)
-epoch_number_str = re.search(r"\d+", load_model_name).group(0)
-start_epoch_number = int(epoch_number_str)
+from explainers.explainer_wrapper import batch_targets
+from ProtoPNet.helpers_funnybirds_multitarget import (
+    find_high_activation_crops,
+    upsample_activation_maps,
+)
+
+
+def load_proto_bound_boxes(model_path, img_dir):
+    """bb table written by push for the epoch of a checkpoint named like 90_14push0.9580.pth"""
+    epoch_number_str = re.search(r"\d+", os.path.basename(model_path)).group(0)
+    return np.load(
+        os.path.join(img_dir, "epoch-" + epoch_number_str, "bb" + epoch_number_str + ".npy")
+    )
+
+
+# Stacked per-sample prototypes of the target class, in descending order of activation:
+# bboxes [B, P, 4], activation_maps [B, P, H, W], activations [B, P], connection_scores [B, P],
+# prototype_indices [B, P] and valid [B, P] (False marks padding, whose entries are zeroed)
+PrototypeAttribution = collections.namedtuple(
+    "PrototypeAttribution",
+    [
+        "bboxes",
+        "activation_maps",
+        "activations",
+        "connection_scores",
+        "prototype_indices",
+        "valid",
+    ],
+)
 
 
 class ppnetexplain:
-    def __init__(self, model):
+    def __init__(self, model, proto_bound_boxes):
+        """
+        Args:
+            model: the ProtoPNetWrapper
+            proto_bound_boxes: [P, 6] bb table of the model's prototypes (from push or a model bundle)
+        """
+        self.model = model
         self.ppnet = model.model
-        self.ppnet_multi = torch.nn.DataParallel(self.ppnet)
-        self.img_size = self.ppnet_multi.module.img_size
+        self.img_size = self.ppnet.img_size
+        self.build_prototype_index(proto_bound_boxes)
+
+    def build_prototype_index(self, proto_bound_boxes):
+        """Device-resident prototype metadata, built once:
+        prototype_img_identity [P]: class of the image each prototype was pushed onto (-1 if none),
+        class_offsets [C + 1] / class_prototypes: CSR table of the prototypes of each class,
+        class_prototype_table / class_prototype_valid [C, M]: the same table padded to the largest class,
+        class_connection_scores [C, M]: last layer weights of each class to its prototypes"""
+        device = self.ppnet.last_layer.weight.device
+        num_classes = self.ppnet.last_layer.weight.shape[0]
+        identity = torch.as_tensor(proto_bound_boxes[:, -1]).long().to(device)
+        self.prototype_img_identity = identity
+
+        assigned = torch.nonzero(identity >= 0).flatten()
+        if len(assigned) == 0:
+            raise ValueError(
+                "no prototype has a class in the bb table (every image identity is -1); "
+                "was it written by push for this model?"
+            )
+        order = torch.argsort(identity[assigned], stable=True)
+        self.class_prototypes = assigned[order]
+        counts = torch.bincount(identity[assigned], minlength=num_classes)
+        self.class_offsets = torch.cat([counts.new_zeros(1), torch.cumsum(counts, dim=0)])
+
+        slots = torch.arange(int(counts.max()), device=device)
+        self.class_prototype_valid = slots[None, :] < counts[:, None]
+        positions = (self.class_offsets[:-1, None] + slots[None, :]).clamp(
+            max=len(self.class_prototypes) - 1
+        )
+        self.class_prototype_table = torch.where(
+            self.class_prototype_valid, self.class_prototypes[positions], 0
+        )
+        with torch.no_grad():
+            self.class_connection_scores = (
+                self.ppnet.last_layer.weight.float().gather(1, self.class_prototype_table)
+                * self.class_prototype_valid
+            )
 
-    # It follows the interface of image and target, just like in part_importances.py at 200
-    def attribute(self, input, target: int):
-        """Returns a generator yielding prototypes with
-        in order,  their bounding boxes, activaiton maps, max_activation value and conn_score"""
+    @staticmethod
+    def truncation_positions(contributions, valid, top_k=None, mass_cutoff=None):
+        """Positions [B, K] of the prototypes with the largest |activation x connection| contributions:
+        at most top_k of them, and only as many as needed to reach mass_cutoff of the total
+        contribution mass. Returns the positions in ascending order and whether each one is kept"""
+        magnitude = contributions.abs().masked_fill(~valid, 0.0)
+        n_keep = magnitude.shape[1] if top_k is None else min(top_k, magnitude.shape[1])
+        kept_magnitude, positions = torch.topk(magnitude, n_keep, dim=1)
+        kept = torch.gather(valid, 1, positions)
+        if mass_cutoff is not None:
+            total = magnitude.sum(dim=1, keepdim=True)
+            # a prototype is kept while the mass of the larger ones is still below the cutoff
+            mass_before = torch.cumsum(kept_magnitude, dim=1) - kept_magnitude
+            kept = kept & (mass_before < mass_cutoff * total)
+            n_keep = int(kept.sum(dim=1).max())
+            positions, kept = positions[:, :n_keep], kept[:, :n_keep]
+        positions, order = torch.sort(positions, dim=1)
+        return positions, torch.gather(kept, 1, order)
+
+    def attribute_batch(self, input, target, top_k=None, mass_cutoff=None):
+        """Batched, on-device counterpart of attribute.
+        Takes a [B, 3, H, W] input with per-sample targets and returns a PrototypeAttribution
+        holding the prototypes of each sample's target class.
+        With top_k or mass_cutoff, only the prototypes selected by truncation_positions are
+        returned (and upsampled), still in descending order of activation"""
 
         prototype_shape = self.ppnet.prototype_shape
         max_dist = prototype_shape[1] * prototype_shape[2] * prototype_shape[3]
+        batch_size = input.shape[0]
+        target = batch_targets(target, batch_size, input.device)
+
+        with torch.no_grad():
+            _, min_distances, distances = self.model.forward_with_distances(input)
+            # distances and activations stay in fp32 under autocast
+            min_distances, distances = min_distances.float(), distances.float()
+            prototype_activations = self.ppnet.distance_2_similarity(min_distances)
+            prototype_activation_patterns = self.ppnet.distance_2_similarity(distances)
+            if self.ppnet.prototype_activation_function == "linear":
+                prototype_activations = prototype_activations + max_dist
+                prototype_activation_patterns = prototype_activation_patterns + max_dist
+
+            # only the target class's prototypes are gathered and sorted
+            class_prototypes = self.class_prototype_table[target]
+            valid = self.class_prototype_valid[target]
+            # The per-prototype generator never reached the least activated prototype
+            valid = valid & (
+                class_prototypes != prototype_activations.argmin(dim=1, keepdim=True)
+            )
+            activations, order = torch.sort(
+                prototype_activations.gather(1, class_prototypes).masked_fill(
+                    ~valid, float("-inf")
+                ),
+                dim=1,
+                descending=True,
+            )
+            prototype_indices = torch.gather(class_prototypes, 1, order)
+            valid = torch.gather(valid, 1, order)
+            activations = activations.masked_fill(~valid, 0.0)
+            connection_scores = (
+                torch.gather(self.class_connection_scores[target], 1, order) * valid
+            )
 
-        _, min_distances = self.ppnet_multi(input)
-        idx = 0
-        distances = self.ppnet.push_forward(input)[1]
-        prototype_activations = self.ppnet.distance_2_similarity(min_distances)
-        prototype_activation_patterns = self.ppnet.distance_2_similarity(distances)
-        if self.ppnet.prototype_activation_function == "linear":
-            prototype_activations = prototype_activations + max_dist
-            prototype_activation_patterns = prototype_activation_patterns + max_dist
-        array_act, sorted_indices_act = torch.sort(prototype_activations[idx])
-
-        prototype_info = np.load(
-            os.path.join(
-                load_img_dir,
-                "epoch-" + epoch_number_str,
-                "bb" + epoch_number_str + ".npy",
+            if top_k is not None or mass_cutoff is not None:
+                positions, kept = self.truncation_positions(
+                    activations * connection_scores, valid, top_k, mass_cutoff
+                )
+                prototype_indices, activations, connection_scores = (
+                    torch.gather(values, 1, positions) * kept
+                    for values in (prototype_indices, activations, connection_scores)
+                )
+                valid = kept
+
+            batch_indices = torch.arange(batch_size, device=input.device)[:, None]
+            activation_maps = upsample_activation_maps(
+                prototype_activation_patterns[batch_indices, prototype_indices],
+                self.img_size,
+            )
+            activation_maps = activation_maps * valid[..., None, None]
+            bboxes = find_high_activation_crops(activation_maps).masked_fill(
+                ~valid[..., None], 0
             )
+
+        return PrototypeAttribution(
+            bboxes,
+            activation_maps,
+            activations,
+            connection_scores,
+            prototype_indices,
+            valid,
         )
-        prototype_img_identity = prototype_info[:, -1]
+
+    # It follows the interface of image and target, just like in part_importances.py at 200
+    def attribute(self, input, target: int):
+        """Returns a generator yielding prototypes with
+        in order,  their bounding boxes, activaiton maps, max_activation value and conn_score"""
+
+        attribution = self.attribute_batch(input, target)
 
         def PrototypeGenerator():
-            for i in range(1, len(sorted_indices_act)):
-                prototype_class = prototype_img_identity[sorted_indices_act[-i].item()]
-                if target == prototype_class:
-                    conn_score = self.ppnet.last_layer.weight[target[0]][
-                        sorted_indices_act[-i].item()
-                    ]
-
-                    max_activation = array_act[-i]
-
-                    activation_pattern = (
-                        prototype_activation_patterns[idx][
-                            sorted_indices_act[-i].item()
-                        ]
-                        .detach()
-                        .cpu()
-                        .numpy()
-                    )
-                    upsampled_activation_pattern = cv2.resize(
-                        activation_pattern,
-                        dsize=(self.img_size, self.img_size),
-                        interpolation=cv2.INTER_CUBIC,
-                    )
-
-                    activation_map = torch.from_numpy(upsampled_activation_pattern)
-
-                    bbox = find_high_activation_crop(upsampled_activation_pattern)
-
-                    yield (bbox, activation_map, max_activation, conn_score)
+            for i in torch.nonzero(attribution.valid[0]).flatten().tolist():
+                bbox = tuple(attribution.bboxes[0, i].tolist())
+                activation_map = attribution.activation_maps[0, i]
+                max_activation = attribution.activations[0, i]
+                conn_score = attribution.connection_scores[0, i]
+
+                yield (bbox, activation_map, max_activation, conn_score)
 
         return PrototypeGenerator()
@@ -0,0 +1,68 @@
+import io
+import pickle
+import sqlite3
+import torch
+
+
+class ResultJournal():
+    def __init__(self, path, commit_every=64):
+        """
+        Append-only SQLite journal of evaluation results, keyed by model checkpoint and explainer (a run).
+        It holds the result of every finished protocol, from which the final table can be recomputed,
+        and every computed explanation, so that a restarted protocol skips the samples already explained.
+        Several worker processes may share one journal.
+        Args:
+            path: SQLite file of the journal
+            commit_every: explanations are written in transactions of this many, not one commit each
+        """
+        self.connection = sqlite3.connect(path, timeout=600)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS protocol_results '
+                                '(model TEXT, explainer TEXT, protocol TEXT, result BLOB, '
+                                'PRIMARY KEY (model, explainer, protocol))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS explanations '
+                                '(model TEXT, explainer TEXT, key TEXT, explanation BLOB, '
+                                'PRIMARY KEY (model, explainer, key))')
+        self.connection.commit()
+        self.commit_every = commit_every
+        # (model, explainer, key) -> serialized explanation, not yet written
+        self.pending_explanations = {}
+
+    def protocol_results(self, run):
+        """All journaled protocol results of a run as a dict protocol -> result"""
+        rows = self.connection.execute('SELECT protocol, result FROM protocol_results WHERE model = ? AND explainer = ?',
+                                       run).fetchall()
+        return {protocol: pickle.loads(result) for protocol, result in rows}
+
+    def record_protocol_result(self, run, protocol, result):
+        self.flush()
+        self.connection.execute('INSERT OR REPLACE INTO protocol_results VALUES (?, ?, ?, ?)',
+                                (*run, protocol, pickle.dumps(result)))
+        self.connection.commit()
+
+    def explanation(self, run, key, map_location=None):
+        """Journaled explanation of a key, loaded onto map_location (it may have been computed on another device)"""
+        blob = self.pending_explanations.get((*run, key))
+        if blob is None:
+            row = self.connection.execute('SELECT explanation FROM explanations WHERE model = ? AND explainer = ? AND key = ?',
+                                          (*run, key)).fetchone()
+            if row is None:
+                return None
+            blob = row[0]
+        return torch.load(io.BytesIO(blob), map_location=map_location)
+
+    def record_explanation(self, run, key, explanation):
+        buffer = io.BytesIO()
+        torch.save(explanation, buffer)
+        self.pending_explanations[(*run, key)] = buffer.getvalue()
+        if len(self.pending_explanations) >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        """Writes the pending explanations in one transaction"""
+        if not self.pending_explanations:
+            return
+        self.connection.executemany('INSERT OR IGNORE INTO explanations VALUES (?, ?, ?, ?)',
+                                    [(*run_key, blob) for run_key, blob in self.pending_explanations.items()])
+        self.connection.commit()
+        self.pending_explanations = {}
@@ -0,0 +1,47 @@
+import torch
+
+from checkpoint_funnybirds_multitarget import state_dict_snapshot
+
+BUNDLE_FORMAT = 'funnybirds-ppnet-bundle-1'
+
+
+def save_model_bundle(path, ppnet, arch, proto_bound_boxes, epoch=None):
+    '''
+    Writes everything the evaluation needs about a trained PPNet into one file:
+    arch: keyword arguments of model.construct_PPNet (without pretrained)
+    proto_bound_boxes: the bb table written by push for the prototypes of ppnet
+    '''
+    torch.save({'format': BUNDLE_FORMAT,
+                'arch': dict(arch),
+                'epoch': epoch,
+                'state_dict': state_dict_snapshot(ppnet),
+                'prototype_class_identity': ppnet.prototype_class_identity.detach().cpu(),
+                'proto_bound_boxes': torch.as_tensor(proto_bound_boxes)}, path)
+
+
+class ModelBundle():
+    '''
+    A model bundle opened without unpickling any code: tensors are memory-mapped (zero-copy)
+    and the PPNet is only constructed on the first call of model()
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.contents = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+        if self.contents.get('format') != BUNDLE_FORMAT:
+            raise ValueError('{} is not a {} file'.format(path, BUNDLE_FORMAT))
+        self.arch = self.contents['arch']
+        self.epoch = self.contents['epoch']
+        self.proto_bound_boxes = self.contents['proto_bound_boxes']
+        self.prototype_class_identity = self.contents['prototype_class_identity']
+        self._model = None
+
+    def model(self, device='cpu'):
+        if self._model is None:
+            # ProtoPNet's model.py, importable once its directory is on sys.path
+            import model
+            ppnet = model.construct_PPNet(pretrained=False, **self.arch)
+            ppnet.load_state_dict(self.contents['state_dict'])
+            ppnet.prototype_class_identity = self.prototype_class_identity.clone()
+            self._model = ppnet
+        self._model = self._model.to(device)
+        return self._model
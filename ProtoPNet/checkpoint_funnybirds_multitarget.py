@@ -0,0 +1,107 @@
+import os
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+
+def state_dict_snapshot(module, prefix=''):
+    '''cpu copy of a state dict, so that training can go on while it is written'''
+    return {prefix + k: v.detach().to('cpu', copy=True) for k, v in module.state_dict().items()}
+
+
+class CheckpointManager():
+    '''
+    Replaces save.save_model_w_condition: keeps the top_k checkpoints above target_accu plus the latest one.
+    Checkpoints are dicts written from a cpu snapshot by a background thread:
+    full ones hold {'arch', 'state_dict'}, last-layer ones hold {'arch', 'last_layer', 'buffers', 'base'}
+    with only the last layer state, the buffers (BatchNorm running statistics keep changing when the
+    last layer is trained on full backbone passes) and the file name of the full checkpoint they apply to.
+    load_ppnet rebuilds the model from either
+    '''
+    def __init__(self, model_dir, arch, top_k=3, target_accu=0.70, log=print):
+        '''
+        arch: keyword arguments of model.construct_PPNet (without pretrained)
+        '''
+        self.model_dir = model_dir
+        self.arch = arch
+        self.top_k = top_k
+        self.target_accu = target_accu
+        self.log = log
+        # a single thread keeps writes and deletions in submission order
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        # file name -> (accu, base file name or None), in the order of saving
+        self.checkpoints = {}
+        self.last_full = None
+
+    def save(self, model, model_name, accu, last_layer_only=False):
+        '''
+        model: the PPNet (not the multi-gpu model)
+        last_layer_only: only the last layer changed since the last full checkpoint
+        '''
+        filename = (model_name + '{0:.4f}.pth').format(accu)
+        if last_layer_only and self.last_full is not None:
+            checkpoint = {'arch': self.arch, 'accu': accu, 'base': self.last_full,
+                          'last_layer': state_dict_snapshot(model.last_layer, prefix='last_layer.'),
+                          'buffers': {name: buffer.detach().to('cpu', copy=True)
+                                      for name, buffer in model.named_buffers()}}
+        else:
+            checkpoint = {'arch': self.arch, 'accu': accu, 'state_dict': state_dict_snapshot(model)}
+            self.last_full = filename
+        self.checkpoints.pop(filename, None)
+        self.checkpoints[filename] = (accu, checkpoint.get('base'))
+        self.submit(self._write, checkpoint, filename)
+        if accu > self.target_accu:
+            self.log('\tabove {0:.2f}%'.format(self.target_accu * 100))
+        for stale in self._stale():
+            del self.checkpoints[stale]
+            self.submit(os.remove, os.path.join(self.model_dir, stale))
+
+    def _write(self, checkpoint, filename):
+        path = os.path.join(self.model_dir, filename)
+        torch.save(checkpoint, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def _stale(self):
+        above = [name for name, (accu, _) in self.checkpoints.items() if accu > self.target_accu]
+        keep = set(sorted(above, key=lambda name: self.checkpoints[name][0], reverse=True)[:self.top_k])
+        keep.add(next(reversed(self.checkpoints)))
+        # full checkpoints stay while a kept last-layer checkpoint refers to them
+        keep |= {self.checkpoints[name][1] for name in keep if self.checkpoints[name][1] is not None}
+        if self.last_full is not None:
+            keep.add(self.last_full)
+        return [name for name in self.checkpoints if name not in keep]
+
+    def submit(self, fn, *args):
+        self.pending.append(self.executor.submit(fn, *args))
+        # surface failed writes early without waiting for the running ones
+        while self.pending and self.pending[0].done():
+            self.pending.pop(0).result()
+
+    def close(self):
+        for future in self.pending:
+            future.result()
+        self.pending = []
+        self.executor.shutdown()
+
+
+def load_ppnet(path, map_location=None):
+    '''
+    Loads a PPNet saved either by CheckpointManager or pickled whole by save.save_model_w_condition
+    '''
+    checkpoint = torch.load(path, map_location=map_location, weights_only=False)
+    if isinstance(checkpoint, torch.nn.Module):
+        return checkpoint
+
+    if 'last_layer' in checkpoint:
+        state_dict = torch.load(os.path.join(os.path.dirname(path), checkpoint['base']),
+                                map_location=map_location, weights_only=False)['state_dict']
+        state_dict.update(checkpoint['last_layer'])
+        state_dict.update(checkpoint.get('buffers', {}))
+    else:
+        state_dict = checkpoint['state_dict']
+
+    # ProtoPNet's model.py, importable once its directory is on sys.path
+    import model
+    ppnet = model.construct_PPNet(pretrained=False, **checkpoint['arch'])
+    ppnet.load_state_dict(state_dict)
+    return ppnet.to(map_location) if map_location is not None else ppnet
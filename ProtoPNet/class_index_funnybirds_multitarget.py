@@ -0,0 +1,70 @@
+import numpy as np
+import torch
+import torch.utils.data
+
+def class_part_table(dataset):
+    '''
+    [num_classes, num_parts] part index of every FunnyBirds class, and the part names of its columns
+    '''
+    part_names = list(dataset.classes[0]['parts'].keys())
+    table = torch.tensor([[class_spec['parts'][part] for part in part_names] for class_spec in dataset.classes])
+    return table, part_names
+
+def admissible_classes(part_idxs, table):
+    '''
+    [B, num_classes] mask of the classes whose parts match every part present in the [B, num_parts] part indices
+    '''
+    part_idxs = part_idxs[:, None, :]
+    return ((part_idxs == table[None]) | (part_idxs == -1)).all(dim=2)
+
+def build_admissible_class_index(dataset):
+    '''
+    [N, ceil(num_classes / 8)] uint8 array packing the admissible classes of every sample of the dataset
+    (bit c of a row, little bit order, is set if class c matches the sample's parts)
+    '''
+    table, part_names = class_part_table(dataset)
+    part_idxs = []
+    for params in dataset.params:
+        part_idxs_single = dataset.single_params_to_part_idxs(params)
+        part_idxs.append([part_idxs_single.get(part, -1) for part in part_names])
+    admissible = admissible_classes(torch.tensor(part_idxs), table)
+    return np.packbits(admissible.numpy(), axis=1, bitorder='little')
+
+def unpack_admissible_classes(packed, num_classes):
+    '''
+    [B, ceil(num_classes / 8)] packed rows of the index -> [B, num_classes] boolean mask
+    '''
+    shifts = torch.arange(8, device=packed.device)
+    bits = (packed[:, :, None].long() >> shifts) & 1
+    return bits.reshape(packed.shape[0], -1)[:, :num_classes].bool()
+
+
+class FunnyBirdsSampleDataset(torch.utils.data.Dataset):
+    '''
+    Wraps a FunnyBirds dataset, adding to each sample
+    samples['admissible_classes']: its packed admissible classes (with_admissible_classes);
+                                   the index is built once at construction
+    samples['index']: its dataset index (with_index), which under a DistributedSampler
+                      can not be derived from the batch position
+    '''
+    def __init__(self, dataset, with_admissible_classes=False, with_index=False):
+        self.dataset = dataset
+        self.index = build_admissible_class_index(dataset) if with_admissible_classes else None
+        self.with_index = with_index
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        sample = self.dataset[idx]
+        if self.index is not None:
+            sample['admissible_classes'] = torch.from_numpy(self.index[idx])
+        if self.with_index:
+            sample['index'] = idx
+        return sample
+
+    def __getattr__(self, name):
+        # classes, parts, get_params_for_single, ... come from the wrapped dataset
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
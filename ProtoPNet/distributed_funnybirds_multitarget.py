@@ -0,0 +1,53 @@
+import os
+import torch
+import torch.distributed as dist
+import torch.utils.data
+
+
+def init_distributed():
+    '''
+    Initializes the process group when launched with torchrun (WORLD_SIZE > 1):
+    nccl on gpu hosts, gloo on cpu-only hosts.
+    Returns (rank, world_size, device); a plain launch gives (0, 1, cuda or cpu)
+    '''
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1, torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+        dist.init_process_group(backend='nccl')
+    else:
+        device = torch.device('cpu')
+        dist.init_process_group(backend='gloo')
+    return dist.get_rank(), dist.get_world_size(), device
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def all_reduce(tensor, op=None):
+    '''in-place all-reduce (sum by default) of tensor over all ranks; a no-op in a single process'''
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM if op is None else op)
+    return tensor
+
+
+def all_gather_cat(tensor):
+    '''concatenation along dim 0 of the equally sized tensors of all ranks, in rank order'''
+    if not is_distributed():
+        return tensor
+    gathered = [torch.empty_like(tensor) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered, tensor.contiguous())
+    return torch.cat(gathered)
+
+
+def is_distributed_loader(dataloader):
+    '''True if every rank only sees its own shard of the dataloader's dataset'''
+    return isinstance(getattr(dataloader, 'sampler', None), torch.utils.data.distributed.DistributedSampler)
@@ -0,0 +1,108 @@
+import os
+import time
+import numpy as np
+import torch
+
+from class_index_funnybirds_multitarget import class_part_table, admissible_classes, unpack_admissible_classes
+from distributed_funnybirds_multitarget import all_gather_cat, get_rank, is_distributed_loader
+from train_and_test_funnybirds_multitarget import batch_part_idxs
+
+
+class FrozenFeatureLoader():
+    '''
+    Iterates over cached min_distances of a dataset like a dataloader over its images.
+    Only valid while features, add-on layers and prototypes are frozen (last_only);
+    _train_or_test then runs the last layer directly on the cached min_distances.
+    Every rank holds the whole cache and draws the same shuffled order (seed + pass number),
+    so distributed ranks train identical last layers without gradient synchronisation.
+    '''
+    def __init__(self, dataset, min_distances, class_idx, admissible, batch_size, device, shuffle=False, seed=0):
+        self.dataset = dataset
+        self.min_distances = min_distances
+        self.class_idx = class_idx
+        self.admissible = admissible
+        self.batch_size = batch_size
+        self.device = device
+        self.shuffle = shuffle
+        self.seed = seed
+        self.n_passes = 0
+
+    def __len__(self):
+        return (len(self.class_idx) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n_samples = len(self.class_idx)
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed + self.n_passes)
+            order = torch.randperm(n_samples, generator=generator)
+        else:
+            order = torch.arange(n_samples)
+        self.n_passes += 1
+        for start in range(0, n_samples, self.batch_size):
+            idx = order[start:start + self.batch_size]
+            min_distances = self.min_distances[idx.numpy()] if isinstance(self.min_distances, np.ndarray) \
+                else self.min_distances[idx.to(self.min_distances.device)]
+            yield {'min_distances': torch.as_tensor(min_distances).to(self.device, non_blocking=True),
+                   'class_idx': self.class_idx[idx],
+                   'admissible': self.admissible[idx.to(self.admissible.device)]}
+
+
+def compute_frozen_features(model, dataloader, shuffle=False, cache_dir=None, name='features', log=print,
+                            input_transform=None):
+    '''
+    model: the multi-gpu model, evaluated in eval mode
+    dataloader: loader over the images to cache; its batch size is kept.
+                With a DistributedSampler every rank computes its shard and the shards are all-gathered
+    cache_dir: if not None, min_distances are stored in a memory-mapped file there instead of on the device
+    input_transform: optional DeviceTransform applied to every image batch on the device (without augmentation)
+    '''
+    start = time.time()
+    model.eval()
+    device = model.module.prototype_vectors.device
+    num_classes = model.module.num_classes
+
+    class_parts, part_names = class_part_table(dataloader.dataset)
+    class_parts = class_parts.to(device)
+
+    min_distances = []
+    class_idx = []
+    admissible = []
+    with torch.no_grad():
+        for samples in dataloader:
+            images = samples['image'].to(device, non_blocking=True)
+            if input_transform is not None:
+                images = input_transform(images)
+            _, batch_min_distances = model(images)
+            min_distances.append(batch_min_distances.float())
+            class_idx.append(samples['class_idx'].to(device))
+            if 'admissible_classes' in samples:
+                admissible.append(unpack_admissible_classes(
+                    samples['admissible_classes'].to(device, non_blocking=True), num_classes))
+            else:
+                part_idxs = batch_part_idxs(dataloader.dataset, samples['params'], images.shape[0], part_names)
+                admissible.append(admissible_classes(part_idxs.to(device, non_blocking=True), class_parts))
+
+    min_distances = torch.cat(min_distances)
+    class_idx = torch.cat(class_idx)
+    # bool is not supported by every backend's all_gather
+    admissible = torch.cat(admissible).to(torch.uint8)
+    if is_distributed_loader(dataloader):
+        # DistributedSampler pads every shard to the same length, so a few samples appear twice
+        min_distances = all_gather_cat(min_distances)
+        class_idx = all_gather_cat(class_idx)
+        admissible = all_gather_cat(admissible)
+    class_idx = class_idx.cpu()
+    admissible = admissible.bool()
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = os.path.join(cache_dir, name + '-min_distances-rank' + str(get_rank()) + '.npy')
+        cached_min_distances = np.lib.format.open_memmap(cache_path, mode='w+', dtype=np.float32,
+                                                         shape=tuple(min_distances.shape))
+        cached_min_distances[:] = min_distances.cpu().numpy()
+        cached_min_distances.flush()
+        min_distances = cached_min_distances
+
+    log('\tcached {0} features: \t{1}'.format(name, time.time() - start))
+    return FrozenFeatureLoader(dataloader.dataset, min_distances, class_idx, admissible,
+                               batch_size=dataloader.batch_size, device=device, shuffle=shuffle)
@@ -0,0 +1,44 @@
+import math
+import torch
+import torch.nn.functional as F
+
+
+def upsample_activation_maps(activation_maps, img_size):
+    """Bicubic upsampling of [..., h, w] activation maps to [..., img_size, img_size].
+    On-device counterpart of cv2.resize(..., interpolation=cv2.INTER_CUBIC)"""
+    leading_shape = activation_maps.shape[:-2]
+    upsampled = F.interpolate(
+        activation_maps.reshape(-1, 1, *activation_maps.shape[-2:]),
+        size=(img_size, img_size),
+        mode="bicubic",
+        align_corners=False,
+    )
+    return upsampled.reshape(*leading_shape, img_size, img_size)
+
+
+def find_high_activation_crops(activation_maps, percentile=95):
+    """Batched helpers.find_high_activation_crop.
+    Takes [..., H, W] activation maps and returns [..., 4] long boxes
+    (lower_y, upper_y, lower_x, upper_x) with exclusive upper bounds."""
+    leading_shape = activation_maps.shape[:-2]
+    height, width = activation_maps.shape[-2:]
+    flat = activation_maps.reshape(-1, height * width)
+
+    # np.percentile with linear interpolation; kthvalue has no size limit unlike torch.quantile
+    position = percentile / 100 * (height * width - 1)
+    lower = math.floor(position)
+    lower_value = flat.kthvalue(lower + 1, dim=1).values
+    upper_value = flat.kthvalue(min(lower + 2, height * width), dim=1).values
+    threshold = lower_value + (upper_value - lower_value) * (position - lower)
+
+    mask = (flat >= threshold[:, None]).reshape(-1, height, width)
+    rows = mask.any(dim=2).float()
+    cols = mask.any(dim=1).float()
+
+    lower_y = rows.argmax(dim=1)
+    upper_y = height - rows.flip(1).argmax(dim=1)
+    lower_x = cols.argmax(dim=1)
+    upper_x = width - cols.flip(1).argmax(dim=1)
+
+    bboxes = torch.stack([lower_y, upper_y, lower_x, upper_x], dim=1)
+    return bboxes.reshape(*leading_shape, 4)
@@ -3,7 +3,8 @@ import shutil
 
 import torch
 import torch.utils.data
-# import torch.utils.data.distributed
+import torch.utils.data.distributed
+import torch.distributed as dist
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 
@@ -12,19 +13,30 @@ import re
 
 from helpers import makedir
 import model
+from model_funnybirds_multitarget import MixedPrecisionPPNet, AMP_DTYPES
+from transform_funnybirds_multitarget import DeviceTransform
 import push_funnybirds_multitarget as push
+from feature_cache_funnybirds_multitarget import compute_frozen_features
 import train_and_test_funnybirds_multitarget as tnt
-import save
+from checkpoint_funnybirds_multitarget import CheckpointManager
 from log import create_logger
-from preprocess import mean, std, preprocess_input_function
+from preprocess import mean, std
 
 from FunnyBirdsFramework.datasets.funny_birds import FunnyBirds
+from FunnyBirdsFramework.datasets.funny_birds_memmap import FunnyBirdsMemmap
+from class_index_funnybirds_multitarget import FunnyBirdsSampleDataset
+from distributed_funnybirds_multitarget import init_distributed
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-gpuid', nargs=1, type=str, default='0') # python3 main.py -gpuid=0,1,2,3
 args = parser.parse_args()
-os.environ['CUDA_VISIBLE_DEVICES'] = args.gpuid[0]
-print(os.environ['CUDA_VISIBLE_DEVICES'])
+# under torchrun (torchrun --nproc_per_node=4 main_funnybirds_multitarget.py) every process
+# uses the gpu of its LOCAL_RANK, and -gpuid is ignored
+if 'WORLD_SIZE' not in os.environ:
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpuid[0]
+    print(os.environ['CUDA_VISIBLE_DEVICES'])
+rank, world_size, device = init_distributed()
+is_main_process = rank == 0
 
 # book keeping namings and code
 from settings_funnybirds_multitarget import base_architecture, img_size, prototype_shape, num_classes, \
@@ -33,43 +45,70 @@ from settings_funnybirds_multitarget import base_architecture, img_size, prototy
 base_architecture_type = re.match('^[a-z]*', base_architecture).group(0)
 
 model_dir = './saved_models/' + base_architecture + '/' + experiment_run + '/'
-makedir(model_dir)
-shutil.copy(src=os.path.join(os.getcwd(), __file__), dst=model_dir)
-shutil.copy(src=os.path.join(os.getcwd(), 'settings_funnybirds_multitarget.py'), dst=model_dir)
-shutil.copy(src=os.path.join(os.getcwd(), base_architecture_type + '_features.py'), dst=model_dir)
-shutil.copy(src=os.path.join(os.getcwd(), 'model.py'), dst=model_dir)
-shutil.copy(src=os.path.join(os.getcwd(), 'train_and_test.py'), dst=model_dir)
-
-log, logclose = create_logger(log_filename=os.path.join(model_dir, 'train.log'))
 img_dir = os.path.join(model_dir, 'img')
-makedir(img_dir)
+# only rank 0 logs and writes to model_dir
+if is_main_process:
+    makedir(model_dir)
+    shutil.copy(src=os.path.join(os.getcwd(), __file__), dst=model_dir)
+    shutil.copy(src=os.path.join(os.getcwd(), 'settings_funnybirds_multitarget.py'), dst=model_dir)
+    shutil.copy(src=os.path.join(os.getcwd(), base_architecture_type + '_features.py'), dst=model_dir)
+    shutil.copy(src=os.path.join(os.getcwd(), 'model.py'), dst=model_dir)
+    shutil.copy(src=os.path.join(os.getcwd(), 'train_and_test.py'), dst=model_dir)
+
+    log, logclose = create_logger(log_filename=os.path.join(model_dir, 'train.log'))
+    makedir(img_dir)
+else:
+    log = lambda *args, **kwargs: None
+    logclose = lambda: None
 weight_matrix_filename = 'outputL_weights'
 prototype_img_filename_prefix = 'prototype-img'
 prototype_self_act_filename_prefix = 'prototype-self-act'
 proto_bound_boxes_filename_prefix = 'bb'
 
 # load the data
-from settings_funnybirds_multitarget import train_dir, test_dir, train_push_dir, \
+from settings_funnybirds_multitarget import train_dir, test_dir, train_push_dir, dataset_cache_dir, \
                      train_batch_size, test_batch_size, train_push_batch_size
 
 # all datasets
+def funnybirds(root, mode):
+    if dataset_cache_dir is None:
+        return FunnyBirds(root, mode, transform = None)
+    # decoded once by build_memmap_dataset.py, shared through the page cache;
+    # the uint8 images are converted by the DeviceTransforms below, after a 4x smaller transfer
+    return FunnyBirdsMemmap(root, mode, os.path.join(dataset_cache_dir, mode), uint8=True)
+
+# images are converted (and augmented for training) on the device, whole batches at a time;
+# as before, training and test see unnormalized images and only push normalizes them
+from settings_funnybirds_multitarget import hflip, color_jitter
+input_transform = DeviceTransform(hflip=hflip, color_jitter=color_jitter)
+push_input_transform = DeviceTransform(mean=mean, std=std)
+pin_memory = device.type == 'cuda'
+
+# in a distributed run every rank loads its own shard of each set (batch sizes are per rank)
+def distributed_sampler(dataset, shuffle):
+    if world_size == 1:
+        return None
+    return torch.utils.data.distributed.DistributedSampler(dataset, shuffle=shuffle)
 # train set
-train_dataset = FunnyBirds(train_dir, 'train', transform = None)
+train_dataset = FunnyBirdsSampleDataset(funnybirds(train_dir, 'train'), with_admissible_classes=True)
+train_sampler = distributed_sampler(train_dataset, shuffle=True)
 train_loader = torch.utils.data.DataLoader(
-    train_dataset, batch_size=train_batch_size, shuffle=True,
-    num_workers=4, pin_memory=False)
-# push set
-train_push_dataset = FunnyBirds(train_push_dir, 'train', transform = None)
+    train_dataset, batch_size=train_batch_size, shuffle=train_sampler is None, sampler=train_sampler,
+    num_workers=4, pin_memory=pin_memory)
+# push set, indexed so that push knows which images the prototypes come from
+train_push_dataset = FunnyBirdsSampleDataset(funnybirds(train_push_dir, 'train'), with_index=True)
 train_push_loader = torch.utils.data.DataLoader(
     train_push_dataset, batch_size=train_push_batch_size, shuffle=False,
-    num_workers=4, pin_memory=False)
+    sampler=distributed_sampler(train_push_dataset, shuffle=False),
+    num_workers=4, pin_memory=pin_memory)
 # test set
-test_dataset = FunnyBirds(test_dir, 'test', transform = None)
+test_dataset = FunnyBirdsSampleDataset(funnybirds(test_dir, 'test'), with_admissible_classes=True)
 test_loader = torch.utils.data.DataLoader(
     test_dataset, batch_size=test_batch_size, shuffle=False,
-    num_workers=4, pin_memory=False)
+    sampler=distributed_sampler(test_dataset, shuffle=False),
+    num_workers=4, pin_memory=pin_memory)
 
-# we should look into distributed sampler more carefully at torch.utils.data.distributed.DistributedSampler(train_dataset)
+log('world size: {0}'.format(world_size))
 log('training set size: {0}'.format(len(train_loader.dataset)))
 log('push set size: {0}'.format(len(train_push_loader.dataset)))
 log('test set size: {0}'.format(len(test_loader.dataset)))
@@ -84,8 +123,18 @@ ppnet = model.construct_PPNet(base_architecture=base_architecture,
                               add_on_layers_type=add_on_layers_type)
 #if prototype_activation_function == 'linear':
 #    ppnet.set_last_layer_incorrect_connection(incorrect_strength=0)
-ppnet = ppnet.cuda()
-ppnet_multi = torch.nn.DataParallel(ppnet)
+ppnet = ppnet.to(device)
+from settings_funnybirds_multitarget import amp, channels_last
+mixed_precision_ppnet = MixedPrecisionPPNet(ppnet, amp_dtype=AMP_DTYPES[amp], channels_last=channels_last)
+if world_size > 1:
+    # warm_only and last_only freeze parts of the network, whose parameters then get no gradients
+    ppnet_multi = torch.nn.parallel.DistributedDataParallel(
+        mixed_precision_ppnet, device_ids=[device.index] if device.type == 'cuda' else None,
+        find_unused_parameters=True)
+else:
+    ppnet_multi = torch.nn.DataParallel(mixed_precision_ppnet)
+# bf16 has the range of fp32 and needs no loss scaling
+scaler = torch.cuda.amp.GradScaler(enabled=amp == 'fp16' and device.type == 'cuda')
 class_specific = True
 
 # define optimizer
@@ -115,33 +164,65 @@ from settings_funnybirds_multitarget import coefs
 # number of training epochs, number of warm epochs, push start epoch, push epochs
 from settings_funnybirds_multitarget import num_train_epochs, num_warm_epochs, push_start, push_epochs
 
+# prototype artifacts are written in the background while training continues
+from settings_funnybirds_multitarget import render_prototype_images, artifact_writer_workers
+artifact_writer = push.PrototypeArtifactWriter(max_workers=artifact_writer_workers,
+                                               render_images=render_prototype_images)
+
+from settings_funnybirds_multitarget import frozen_feature_cache, frozen_feature_cache_dir, p_dist_pair_interval
+
+# keeps the best checkpoints and the latest one, written in the background
+from settings_funnybirds_multitarget import checkpoint_top_k
+checkpoint_manager = CheckpointManager(model_dir,
+                                       arch=dict(base_architecture=base_architecture, img_size=img_size,
+                                                 prototype_shape=prototype_shape, num_classes=num_classes,
+                                                 prototype_activation_function=prototype_activation_function,
+                                                 add_on_layers_type=add_on_layers_type),
+                                       top_k=checkpoint_top_k, target_accu=0.70, log=log)
+
+def save_model_w_condition(model_name, accu, last_layer_only=False):
+    if is_main_process:
+        checkpoint_manager.save(model=ppnet, model_name=model_name, accu=accu, last_layer_only=last_layer_only)
+
 # train the model
 log('start training')
 import copy
+n_train_passes = 0
+def next_train_pass():
+    # reshuffles the distributed train shards before every pass over the train set
+    global n_train_passes
+    if train_sampler is not None:
+        train_sampler.set_epoch(n_train_passes)
+    n_train_passes += 1
+
 for epoch in range(num_train_epochs):
     log('epoch: \t{0}'.format(epoch))
+    next_train_pass()
+    log_p_dist_pair = epoch % p_dist_pair_interval == 0
 
     if epoch < num_warm_epochs:
         tnt.warm_only(model=ppnet_multi, log=log)
         _ = tnt.train(model=ppnet_multi, dataloader=train_loader, optimizer=warm_optimizer,
-                      class_specific=class_specific, coefs=coefs, log=log)
+                      class_specific=class_specific, coefs=coefs, log=log, scaler=scaler,
+                      log_p_dist_pair=log_p_dist_pair, input_transform=input_transform)
     else:
         tnt.joint(model=ppnet_multi, log=log)
         joint_lr_scheduler.step()
         _ = tnt.train(model=ppnet_multi, dataloader=train_loader, optimizer=joint_optimizer,
-                      class_specific=class_specific, coefs=coefs, log=log)
+                      class_specific=class_specific, coefs=coefs, log=log, scaler=scaler,
+                      log_p_dist_pair=log_p_dist_pair, input_transform=input_transform)
 
     accu = tnt.test(model=ppnet_multi, dataloader=test_loader,
-                    class_specific=class_specific, log=log)
-    save.save_model_w_condition(model=ppnet, model_dir=model_dir, model_name=str(epoch) + 'nopush', accu=accu,
-                                target_accu=0.70, log=log)
+                    class_specific=class_specific, log=log, log_p_dist_pair=log_p_dist_pair,
+                    input_transform=input_transform)
+    save_model_w_condition(model_name=str(epoch) + 'nopush', accu=accu)
 
     if epoch >= push_start and epoch in push_epochs:
         push.push_prototypes(
-            train_push_loader, # pytorch dataloader (must be unnormalized in [0,1])
+            train_push_loader, # pytorch dataloader (must be unnormalized, in [0,1] or uint8)
             prototype_network_parallel=ppnet_multi, # pytorch network with prototype_vectors
             class_specific=class_specific,
-            preprocess_input_function=preprocess_input_function, # normalize if needed
+            preprocess_input_function=push_input_transform, # normalize on the device
             prototype_layer_stride=1,
             root_dir_for_saving_prototypes=img_dir, # if not None, prototypes will be saved here
             epoch_number=epoch, # if not provided, prototypes saved previously will be overwritten
@@ -149,22 +230,40 @@ for epoch in range(num_train_epochs):
             prototype_self_act_filename_prefix=prototype_self_act_filename_prefix,
             proto_bound_boxes_filename_prefix=proto_bound_boxes_filename_prefix,
             save_prototype_class_identity=True,
-            log=log)
+            log=log,
+            artifact_writer=artifact_writer)
+        # push has just moved the prototypes
         accu = tnt.test(model=ppnet_multi, dataloader=test_loader,
-                        class_specific=class_specific, log=log)
-        save.save_model_w_condition(model=ppnet, model_dir=model_dir, model_name=str(epoch) + 'push', accu=accu,
-                                    target_accu=0.70, log=log)
+                        class_specific=class_specific, log=log, log_p_dist_pair=True,
+                        input_transform=input_transform)
+        save_model_w_condition(model_name=str(epoch) + 'push', accu=accu)
 
         if prototype_activation_function != 'linear':
             tnt.last_only(model=ppnet_multi, log=log)
+            if frozen_feature_cache:
+                last_layer_train_loader = compute_frozen_features(ppnet_multi, train_loader, shuffle=True,
+                                                                  cache_dir=frozen_feature_cache_dir, name='train', log=log,
+                                                                  input_transform=input_transform)
+                last_layer_test_loader = compute_frozen_features(ppnet_multi, test_loader,
+                                                                 cache_dir=frozen_feature_cache_dir, name='test', log=log,
+                                                                 input_transform=input_transform)
+            else:
+                last_layer_train_loader, last_layer_test_loader = train_loader, test_loader
             for i in range(20):
                 log('iteration: \t{0}'.format(i))
-                _ = tnt.train(model=ppnet_multi, dataloader=train_loader, optimizer=last_layer_optimizer,
-                              class_specific=class_specific, coefs=coefs, log=log)
-                accu = tnt.test(model=ppnet_multi, dataloader=test_loader,
-                                class_specific=class_specific, log=log)
-                save.save_model_w_condition(model=ppnet, model_dir=model_dir, model_name=str(epoch) + '_' + str(i) + 'push', accu=accu,
-                                            target_accu=0.70, log=log)
-   
+                next_train_pass()
+                _ = tnt.train(model=ppnet_multi, dataloader=last_layer_train_loader, optimizer=last_layer_optimizer,
+                              class_specific=class_specific, coefs=coefs, log=log, scaler=scaler,
+                              log_p_dist_pair=False, input_transform=input_transform)
+                # the prototypes are frozen, so their pair distance is the one logged after push
+                accu = tnt.test(model=ppnet_multi, dataloader=last_layer_test_loader,
+                                class_specific=class_specific, log=log, log_p_dist_pair=False,
+                                input_transform=input_transform)
+                save_model_w_condition(model_name=str(epoch) + '_' + str(i) + 'push', accu=accu, last_layer_only=True)
+
+artifact_writer.close()
+checkpoint_manager.close()
 logclose()
+if world_size > 1:
+    dist.destroy_process_group()
 
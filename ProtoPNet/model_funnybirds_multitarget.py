@@ -0,0 +1,55 @@
+import contextlib
+import torch
+import torch.nn as nn
+
+# values of amp in the [training] section of model_selection.toml
+AMP_DTYPES = {'none': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def forward_with_distances(ppnet, x, amp_dtype=None, channels_last=False):
+    '''
+    Single backbone evaluation of a PPNet returning what forward and push_forward
+    return separately: logits, min_distances and the full distance maps.
+    Only the backbone and add-on layers run under autocast with amp_dtype (or an enclosing
+    autocast if amp_dtype is None); distances, log activations and the last layer are
+    always computed in fp32
+    '''
+    if channels_last:
+        x = x.contiguous(memory_format=torch.channels_last)
+    backbone_autocast = contextlib.nullcontext() if amp_dtype is None else torch.autocast(x.device.type, dtype=amp_dtype)
+    with backbone_autocast:
+        conv_features = ppnet.conv_features(x)
+    with torch.autocast(x.device.type, enabled=False):
+        distances = ppnet._l2_convolution(conv_features.float())
+        # global min pooling, equal to -max_pool2d(-distances) over the whole map in PPNet.forward
+        min_distances = torch.amin(distances, dim=(2, 3))
+        prototype_activations = ppnet.distance_2_similarity(min_distances)
+        logits = ppnet.last_layer(prototype_activations)
+    return logits, min_distances, distances
+
+
+class MixedPrecisionPPNet(nn.Module):
+    '''
+    PPNet whose forward runs the backbone in mixed precision and/or channels-last memory format.
+    Wrap it in DataParallel instead of the PPNet; every other attribute (prototype_shape,
+    last_layer, push_forward, ...) is looked up on the wrapped PPNet, so model.module
+    can be used as before
+    '''
+    def __init__(self, ppnet, amp_dtype=None, channels_last=False):
+        super().__init__()
+        self.ppnet = ppnet
+        self.amp_dtype = amp_dtype
+        self.channels_last = channels_last
+        if channels_last:
+            ppnet.features.to(memory_format=torch.channels_last)
+            ppnet.add_on_layers.to(memory_format=torch.channels_last)
+
+    def forward(self, x):
+        logits, min_distances, _ = forward_with_distances(self.ppnet, x, self.amp_dtype, self.channels_last)
+        return logits, min_distances
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self.ppnet, name)
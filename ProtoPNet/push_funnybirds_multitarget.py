@@ -3,11 +3,38 @@ import numpy as np
 import matplotlib.pyplot as plt
 import cv2
 import os
-import copy
 import time
+from concurrent.futures import ThreadPoolExecutor
+import torch.distributed as dist
 
 from receptive_field import compute_rf_prototype
-from helpers import makedir, find_high_activation_crop
+from helpers import makedir
+from helpers_funnybirds_multitarget import find_high_activation_crops, upsample_activation_maps
+from distributed_funnybirds_multitarget import all_reduce, get_rank, is_distributed
+
+# renders and writes the prototype artifacts of the final push winners in background threads
+class PrototypeArtifactWriter():
+    def __init__(self, max_workers=4, render_images=True):
+        '''
+        max_workers: number of writer threads
+        render_images: if False, only the self activation arrays are written and the png rendering is skipped
+        '''
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.render_images = render_images
+        self.pending = []
+
+    def submit(self, fn, *args):
+        self.pending.append(self.executor.submit(fn, *args))
+
+    def wait(self):
+        # blocks until everything submitted so far is on disk, re-raising the first failure
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
 
 # push each prototype to the nearest patch in the training set
 def push_prototypes(dataloader, # pytorch dataloader (must be unnormalized in [0,1])
@@ -22,7 +49,9 @@ def push_prototypes(dataloader, # pytorch dataloader (must be unnormalized in [0
                     proto_bound_boxes_filename_prefix=None,
                     save_prototype_class_identity=True, # which class the prototype image comes from
                     log=print,
-                    prototype_activation_function_in_numpy=None):
+                    prototype_activation_function_in_numpy=None,
+                    artifact_writer=None, # if not None, artifacts are written in the background and push returns without waiting
+                    render_prototype_images=True): # used only when artifact_writer is None
 
     prototype_network_parallel.eval()
     log('\tpush')
@@ -30,36 +59,30 @@ def push_prototypes(dataloader, # pytorch dataloader (must be unnormalized in [0
     start = time.time()
     prototype_shape = prototype_network_parallel.module.prototype_shape
     n_prototypes = prototype_network_parallel.module.num_prototypes
+    device = prototype_network_parallel.module.prototype_vectors.device
+    # the search state stays on the device until the whole push set has been seen
     # saves the closest distance seen so far
-    global_min_proto_dist = np.full(n_prototypes, np.inf)
+    global_min_proto_dist = torch.full([n_prototypes], float('inf'), device=device)
     # saves the patch representation that gives the current smallest distance
-    global_min_fmap_patches = np.zeros(
+    global_min_fmap_patches = torch.zeros(
         [n_prototypes,
          prototype_shape[1],
          prototype_shape[2],
-         prototype_shape[3]])
-
+         prototype_shape[3]], device=device)
+    # saves the distance map of the image holding that patch
+    global_min_dist_maps = None
     '''
-    proto_rf_boxes and proto_bound_boxes column:
+    global_min_locations column:
     0: image index in the entire dataset
-    1: height start index
-    2: height end index
-    3: width start index
-    4: width end index
-    5: (optional) class identity
+    1: class of the image (-1 if unknown)
+    2: height index in the distance map
+    3: width index in the distance map
     '''
-    if save_prototype_class_identity:
-        proto_rf_boxes = np.full(shape=[n_prototypes, 6],
-                                    fill_value=-1)
-        proto_bound_boxes = np.full(shape=[n_prototypes, 6],
-                                            fill_value=-1)
-    else:
-        proto_rf_boxes = np.full(shape=[n_prototypes, 5],
-                                    fill_value=-1)
-        proto_bound_boxes = np.full(shape=[n_prototypes, 5],
-                                            fill_value=-1)
+    global_min_locations = torch.full([n_prototypes, 4], -1, dtype=torch.long, device=device)
 
-    if root_dir_for_saving_prototypes != None:
+    # with a DistributedSampler every rank searches its shard; only rank 0 computes boxes and saves
+    is_saving_rank = get_rank() == 0
+    if root_dir_for_saving_prototypes != None and is_saving_rank:
         if epoch_number != None:
             proto_epoch_dir = os.path.join(root_dir_for_saving_prototypes,
                                            'epoch-'+str(epoch_number))
@@ -69,6 +92,11 @@ def push_prototypes(dataloader, # pytorch dataloader (must be unnormalized in [0
     else:
         proto_epoch_dir = None
 
+    if artifact_writer is None:
+        own_artifact_writer = PrototypeArtifactWriter(render_images=render_prototype_images)
+    else:
+        own_artifact_writer = None
+
     search_batch_size = dataloader.batch_size
 
     num_classes = prototype_network_parallel.module.num_classes
@@ -81,229 +109,314 @@ def push_prototypes(dataloader, # pytorch dataloader (must be unnormalized in [0
         '''
         search_batch_input = samples['image']#.cuda(non_blocking=True)
         search_y = samples['class_idx']
+        # dataset indices of the batch, required when the loader does not go through the dataset in order
+        search_index = samples.get('index')
 
         start_index_of_search_batch = push_iter * search_batch_size
 
-        update_prototypes_on_batch(search_batch_input,
+        global_min_dist_maps = update_prototypes_on_batch(search_batch_input,
                                    start_index_of_search_batch,
                                    prototype_network_parallel,
                                    global_min_proto_dist,
                                    global_min_fmap_patches,
-                                   proto_rf_boxes,
-                                   proto_bound_boxes,
+                                   global_min_dist_maps,
+                                   global_min_locations,
                                    class_specific=class_specific,
                                    search_y=search_y,
                                    num_classes=num_classes,
                                    preprocess_input_function=preprocess_input_function,
                                    prototype_layer_stride=prototype_layer_stride,
-                                   dir_for_saving_prototypes=proto_epoch_dir,
-                                   prototype_img_filename_prefix=prototype_img_filename_prefix,
-                                   prototype_self_act_filename_prefix=prototype_self_act_filename_prefix,
-                                   prototype_activation_function_in_numpy=prototype_activation_function_in_numpy)
+                                   search_index=search_index)
+
+    reduce_push_state(global_min_proto_dist, global_min_fmap_patches, global_min_dist_maps, global_min_locations)
+
+    if is_saving_rank:
+        proto_rf_boxes, proto_bound_boxes = find_prototype_boxes(dataloader.dataset,
+                                                                 prototype_network_parallel,
+                                                                 global_min_proto_dist,
+                                                                 global_min_dist_maps,
+                                                                 global_min_locations,
+                                                                 save_prototype_class_identity=save_prototype_class_identity,
+                                                                 dir_for_saving_prototypes=proto_epoch_dir,
+                                                                 prototype_img_filename_prefix=prototype_img_filename_prefix,
+                                                                 prototype_self_act_filename_prefix=prototype_self_act_filename_prefix,
+                                                                 prototype_activation_function_in_numpy=prototype_activation_function_in_numpy,
+                                                                 artifact_writer=artifact_writer or own_artifact_writer)
 
-    if proto_epoch_dir != None and proto_bound_boxes_filename_prefix != None:
-        np.save(os.path.join(proto_epoch_dir, proto_bound_boxes_filename_prefix + '-receptive_field' + str(epoch_number) + '.npy'),
-                proto_rf_boxes)
-        np.save(os.path.join(proto_epoch_dir, proto_bound_boxes_filename_prefix + str(epoch_number) + '.npy'),
-                proto_bound_boxes)
+        if proto_epoch_dir != None and proto_bound_boxes_filename_prefix != None:
+            np.save(os.path.join(proto_epoch_dir, proto_bound_boxes_filename_prefix + '-receptive_field' + str(epoch_number) + '.npy'),
+                    proto_rf_boxes)
+            np.save(os.path.join(proto_epoch_dir, proto_bound_boxes_filename_prefix + str(epoch_number) + '.npy'),
+                    proto_bound_boxes)
 
     log('\tExecuting push ...')
-    prototype_update = np.reshape(global_min_fmap_patches,
-                                  tuple(prototype_shape))
-    prototype_network_parallel.module.prototype_vectors.data.copy_(torch.tensor(prototype_update, dtype=torch.float32).cuda())
+    prototype_network_parallel.module.prototype_vectors.data.copy_(global_min_fmap_patches)
     # prototype_network_parallel.cuda()
+    if own_artifact_writer is not None:
+        own_artifact_writer.close()
     end = time.time()
     log('\tpush time: \t{0}'.format(end -  start))
 
 # update each prototype for current search batch
+# all prototypes are searched at once on the device; boxes are only computed for the winners by find_prototype_boxes
 def update_prototypes_on_batch(search_batch_input,
                                start_index_of_search_batch,
                                prototype_network_parallel,
                                global_min_proto_dist, # this will be updated
                                global_min_fmap_patches, # this will be updated
-                               proto_rf_boxes, # this will be updated
-                               proto_bound_boxes, # this will be updated
+                               global_min_dist_maps, # this will be updated (None before the first batch)
+                               global_min_locations, # this will be updated
                                class_specific=True,
                                search_y=None, # required if class_specific == True
                                num_classes=None, # required if class_specific == True
                                preprocess_input_function=None,
                                prototype_layer_stride=1,
-                               dir_for_saving_prototypes=None,
-                               prototype_img_filename_prefix=None,
-                               prototype_self_act_filename_prefix=None,
-                               prototype_activation_function_in_numpy=None):
+                               search_index=None): # dataset indices of the batch, if not start_index_of_search_batch + position
 
     prototype_network_parallel.eval()
 
-    if preprocess_input_function is not None:
-        # print('preprocessing input for pushing ...')
-        # search_batch = copy.deepcopy(search_batch_input)
-        search_batch = preprocess_input_function(search_batch_input)
-
-    else:
-        search_batch = search_batch_input
+    prototype_shape = prototype_network_parallel.module.prototype_shape
+    n_prototypes = prototype_shape[0]
+    proto_h = prototype_shape[2]
+    proto_w = prototype_shape[3]
+    device = global_min_proto_dist.device
 
     with torch.no_grad():
-        search_batch = search_batch.cuda()
+        # the batch is preprocessed on the device, after the (possibly uint8) transfer
+        search_batch = search_batch_input.to(device, non_blocking=True)
+        if preprocess_input_function is not None:
+            search_batch = preprocess_input_function(search_batch)
         # this computation currently is not parallelized
-        protoL_input_torch, proto_dist_torch = prototype_network_parallel.module.push_forward(search_batch)
+        protoL_input, proto_dist = prototype_network_parallel.module.push_forward(search_batch)
+        n_images, _, dist_h, dist_w = proto_dist.shape
 
-    protoL_input_ = np.copy(protoL_input_torch.detach().cpu().numpy())
-    proto_dist_ = np.copy(proto_dist_torch.detach().cpu().numpy())
+        if global_min_dist_maps is None:
+            global_min_dist_maps = torch.zeros([n_prototypes, dist_h, dist_w], device=device)
 
-    del protoL_input_torch, proto_dist_torch
+        if search_y is not None:
+            search_y = search_y.to(device)
+        if class_specific:
+            # target_class is the class of the class_specific prototype;
+            # only images of the target_class are searched for it
+            target_class = torch.argmax(prototype_network_parallel.module.prototype_class_identity, dim=1).to(device)
+            of_target_class = search_y[:, None] == target_class[None, :]
+            proto_dist = proto_dist.masked_fill(~of_target_class[:, :, None, None], float('inf'))
 
-    if class_specific:
-        class_to_img_index_dict = {key: [] for key in range(num_classes)}
-        # img_y is the image's integer label
-        for img_index, img_y in enumerate(search_y):
-            img_label = img_y.item()
-            class_to_img_index_dict[img_label].append(img_index)
+        # minimum of every prototype over all images and locations of the batch
+        batch_min_proto_dist, batch_argmin_proto_dist = \
+            proto_dist.transpose(0, 1).reshape(n_prototypes, -1).min(dim=1)
+        # prototypes without images of their class in the batch stay at inf and are not updated
+        improved = batch_min_proto_dist < global_min_proto_dist
 
-    prototype_shape = prototype_network_parallel.module.prototype_shape
+        img_index_in_batch = batch_argmin_proto_dist // (dist_h * dist_w)
+        dist_height_index = batch_argmin_proto_dist // dist_w % dist_h
+        dist_width_index = batch_argmin_proto_dist % dist_w
+
+        # retrieve the corresponding feature map patches with a single gather
+        fmap_height_indices = (dist_height_index * prototype_layer_stride)[:, None] + torch.arange(proto_h, device=device)
+        fmap_width_indices = (dist_width_index * prototype_layer_stride)[:, None] + torch.arange(proto_w, device=device)
+        batch_min_fmap_patches = protoL_input[img_index_in_batch[:, None, None],
+                                              :,
+                                              fmap_height_indices[:, :, None],
+                                              fmap_width_indices[:, None, :]].permute(0, 3, 1, 2)
+
+        if search_y is not None:
+            img_class = search_y[img_index_in_batch]
+        else:
+            img_class = torch.full_like(img_index_in_batch, -1)
+        if search_index is not None:
+            img_index = search_index.to(device)[img_index_in_batch]
+        else:
+            img_index = img_index_in_batch + start_index_of_search_batch
+        batch_min_locations = torch.stack([img_index,
+                                           img_class,
+                                           dist_height_index,
+                                           dist_width_index], dim=1)
+        batch_min_dist_maps = proto_dist[img_index_in_batch, torch.arange(n_prototypes, device=device)]
+
+        global_min_proto_dist[improved] = batch_min_proto_dist[improved]
+        global_min_fmap_patches[improved] = batch_min_fmap_patches[improved]
+        global_min_dist_maps[improved] = batch_min_dist_maps[improved]
+        global_min_locations[improved] = batch_min_locations[improved]
+
+    return global_min_dist_maps
+
+# cross-rank min-reduction of the push search state: every prototype takes the patch
+# of the rank that found the smallest distance (the lowest such rank on ties)
+def reduce_push_state(global_min_proto_dist, # this will be updated
+                      global_min_fmap_patches, # this will be updated
+                      global_min_dist_maps, # this will be updated
+                      global_min_locations): # this will be updated
+    if not is_distributed():
+        return
+
+    rank = dist.get_rank()
+    local_min_proto_dist = global_min_proto_dist.clone()
+    all_reduce(global_min_proto_dist, dist.ReduceOp.MIN)
+    owner = torch.full_like(global_min_locations[:, 0], dist.get_world_size())
+    owner[local_min_proto_dist == global_min_proto_dist] = rank
+    all_reduce(owner, dist.ReduceOp.MIN)
+
+    # only the owner contributes to the sum; unfound prototypes are owned by rank 0 and keep their -1 locations
+    not_owned = owner != rank
+    for state in (global_min_fmap_patches, global_min_dist_maps, global_min_locations):
+        state[not_owned] = 0
+        all_reduce(state)
+
+# bounding boxes and artifacts of the final nearest patches, once the whole push set has been searched
+def find_prototype_boxes(dataset,
+                         prototype_network_parallel,
+                         global_min_proto_dist,
+                         global_min_dist_maps,
+                         global_min_locations,
+                         save_prototype_class_identity=True,
+                         dir_for_saving_prototypes=None,
+                         prototype_img_filename_prefix=None,
+                         prototype_self_act_filename_prefix=None,
+                         prototype_activation_function_in_numpy=None,
+                         artifact_writer=None):
+
+    module = prototype_network_parallel.module
+    prototype_shape = module.prototype_shape
     n_prototypes = prototype_shape[0]
-    proto_h = prototype_shape[2]
-    proto_w = prototype_shape[3]
     max_dist = prototype_shape[1] * prototype_shape[2] * prototype_shape[3]
 
-    for j in range(n_prototypes):
-        #if n_prototypes_per_class != None:
-        if class_specific:
-            # target_class is the class of the class_specific prototype
-            target_class = torch.argmax(prototype_network_parallel.module.prototype_class_identity[j]).item()
-            # if there is not images of the target_class from this batch
-            # we go on to the next prototype
-            if len(class_to_img_index_dict[target_class]) == 0:
-                continue
-            proto_dist_j = proto_dist_[class_to_img_index_dict[target_class]][:,j,:,:]
-        else:
-            # if it is not class specific, then we will search through
-            # every example
-            proto_dist_j = proto_dist_[:,j,:,:]
-
-        batch_min_proto_dist_j = np.amin(proto_dist_j)
-        if batch_min_proto_dist_j < global_min_proto_dist[j]:
-            batch_argmin_proto_dist_j = \
-                list(np.unravel_index(np.argmin(proto_dist_j, axis=None),
-                                      proto_dist_j.shape))
-            if class_specific:
-                '''
-                change the argmin index from the index among
-                images of the target class to the index in the entire search
-                batch
-                '''
-                batch_argmin_proto_dist_j[0] = class_to_img_index_dict[target_class][batch_argmin_proto_dist_j[0]]
-
-            # retrieve the corresponding feature map patch
-            img_index_in_batch = batch_argmin_proto_dist_j[0]
-            fmap_height_start_index = batch_argmin_proto_dist_j[1] * prototype_layer_stride
-            fmap_height_end_index = fmap_height_start_index + proto_h
-            fmap_width_start_index = batch_argmin_proto_dist_j[2] * prototype_layer_stride
-            fmap_width_end_index = fmap_width_start_index + proto_w
-
-            batch_min_fmap_patch_j = protoL_input_[img_index_in_batch,
-                                                   :,
-                                                   fmap_height_start_index:fmap_height_end_index,
-                                                   fmap_width_start_index:fmap_width_end_index]
-
-            global_min_proto_dist[j] = batch_min_proto_dist_j
-            global_min_fmap_patches[j] = batch_min_fmap_patch_j
-            
-            # get the receptive field boundary of the image patch
-            # that generates the representation
-            protoL_rf_info = prototype_network_parallel.module.proto_layer_rf_info
-            rf_prototype_j = compute_rf_prototype(search_batch.size(2), batch_argmin_proto_dist_j, protoL_rf_info)
-            
-            # get the whole image
-            original_img_j = search_batch_input[rf_prototype_j[0]]
-            original_img_j = original_img_j.numpy()
-            original_img_j = np.transpose(original_img_j, (1, 2, 0))
-            original_img_size = original_img_j.shape[0]
-            
-            # crop out the receptive field
-            rf_img_j = original_img_j[rf_prototype_j[1]:rf_prototype_j[2],
-                                      rf_prototype_j[3]:rf_prototype_j[4], :]
-            
-            # save the prototype receptive field information
-            proto_rf_boxes[j, 0] = rf_prototype_j[0] + start_index_of_search_batch
-            proto_rf_boxes[j, 1] = rf_prototype_j[1]
-            proto_rf_boxes[j, 2] = rf_prototype_j[2]
-            proto_rf_boxes[j, 3] = rf_prototype_j[3]
-            proto_rf_boxes[j, 4] = rf_prototype_j[4]
-            if proto_rf_boxes.shape[1] == 6 and search_y is not None:
-                proto_rf_boxes[j, 5] = search_y[rf_prototype_j[0]].item()
-
-            # find the highly activated region of the original image
-            proto_dist_img_j = proto_dist_[img_index_in_batch, j, :, :]
-            if prototype_network_parallel.module.prototype_activation_function == 'log':
-                proto_act_img_j = np.log((proto_dist_img_j + 1) / (proto_dist_img_j + prototype_network_parallel.module.epsilon))
-            elif prototype_network_parallel.module.prototype_activation_function == 'linear':
-                proto_act_img_j = max_dist - proto_dist_img_j
-            else:
-                proto_act_img_j = prototype_activation_function_in_numpy(proto_dist_img_j)
-            upsampled_act_img_j = cv2.resize(proto_act_img_j, dsize=(original_img_size, original_img_size),
-                                             interpolation=cv2.INTER_CUBIC)
-            proto_bound_j = find_high_activation_crop(upsampled_act_img_j)
-            # crop out the image patch with high activation as prototype image
-            proto_img_j = original_img_j[proto_bound_j[0]:proto_bound_j[1],
-                                         proto_bound_j[2]:proto_bound_j[3], :]
-
-            # save the prototype boundary (rectangular boundary of highly activated region)
-            proto_bound_boxes[j, 0] = proto_rf_boxes[j, 0]
-            proto_bound_boxes[j, 1] = proto_bound_j[0]
-            proto_bound_boxes[j, 2] = proto_bound_j[1]
-            proto_bound_boxes[j, 3] = proto_bound_j[2]
-            proto_bound_boxes[j, 4] = proto_bound_j[3]
-            if proto_bound_boxes.shape[1] == 6 and search_y is not None:
-                proto_bound_boxes[j, 5] = search_y[rf_prototype_j[0]].item()
-
-            if dir_for_saving_prototypes is not None:
-                if prototype_self_act_filename_prefix is not None:
-                    # save the numpy array of the prototype self activation
-                    np.save(os.path.join(dir_for_saving_prototypes,
-                                         prototype_self_act_filename_prefix + str(j) + '.npy'),
-                            proto_act_img_j)
-                if prototype_img_filename_prefix is not None:
-                    # save the whole image containing the prototype as png
-                    plt.imsave(os.path.join(dir_for_saving_prototypes,
-                                            prototype_img_filename_prefix + '-original' + str(j) + '.png'),
-                               original_img_j,
-                               vmin=0.0,
-                               vmax=1.0)
-                    # overlay (upsampled) self activation on original image and save the result
-                    rescaled_act_img_j = upsampled_act_img_j - np.amin(upsampled_act_img_j)
-                    rescaled_act_img_j = rescaled_act_img_j / np.amax(rescaled_act_img_j)
-                    heatmap = cv2.applyColorMap(np.uint8(255*rescaled_act_img_j), cv2.COLORMAP_JET)
-                    heatmap = np.float32(heatmap) / 255
-                    heatmap = heatmap[...,::-1]
-                    overlayed_original_img_j = 0.5 * original_img_j + 0.3 * heatmap
-                    plt.imsave(os.path.join(dir_for_saving_prototypes,
-                                            prototype_img_filename_prefix + '-original_with_self_act' + str(j) + '.png'),
-                               overlayed_original_img_j,
-                               vmin=0.0,
-                               vmax=1.0)
-                    
-                    # if different from the original (whole) image, save the prototype receptive field as png
-                    if rf_img_j.shape[0] != original_img_size or rf_img_j.shape[1] != original_img_size:
-                        plt.imsave(os.path.join(dir_for_saving_prototypes,
-                                                prototype_img_filename_prefix + '-receptive_field' + str(j) + '.png'),
-                                   rf_img_j,
-                                   vmin=0.0,
-                                   vmax=1.0)
-                        overlayed_rf_img_j = overlayed_original_img_j[rf_prototype_j[1]:rf_prototype_j[2],
-                                                                      rf_prototype_j[3]:rf_prototype_j[4]]
-                        plt.imsave(os.path.join(dir_for_saving_prototypes,
-                                                prototype_img_filename_prefix + '-receptive_field_with_self_act' + str(j) + '.png'),
-                                   overlayed_rf_img_j,
-                                   vmin=0.0,
-                                   vmax=1.0)
-                    
-                    # save the prototype image (highly activated region of the whole image)
-                    plt.imsave(os.path.join(dir_for_saving_prototypes,
-                                            prototype_img_filename_prefix + str(j) + '.png'),
-                               proto_img_j,
-                               vmin=0.0,
-                               vmax=1.0)
-                
-    if class_specific:
-        del class_to_img_index_dict
+    '''
+    proto_rf_boxes and proto_bound_boxes column:
+    0: image index in the entire dataset
+    1: height start index
+    2: height end index
+    3: width start index
+    4: width end index
+    5: (optional) class identity
+    '''
+    if save_prototype_class_identity:
+        proto_rf_boxes = np.full(shape=[n_prototypes, 6],
+                                    fill_value=-1)
+        proto_bound_boxes = np.full(shape=[n_prototypes, 6],
+                                            fill_value=-1)
+    else:
+        proto_rf_boxes = np.full(shape=[n_prototypes, 5],
+                                    fill_value=-1)
+        proto_bound_boxes = np.full(shape=[n_prototypes, 5],
+                                            fill_value=-1)
+
+    # only prototypes that found a patch during the search
+    found = torch.nonzero(torch.isfinite(global_min_proto_dist)).flatten()
+    if len(found) == 0:
+        return proto_rf_boxes, proto_bound_boxes
+
+    # find the highly activated regions of all winners at once
+    proto_dist_imgs = global_min_dist_maps[found]
+    if module.prototype_activation_function == 'log':
+        proto_act_imgs = torch.log((proto_dist_imgs + 1) / (proto_dist_imgs + module.epsilon))
+    elif module.prototype_activation_function == 'linear':
+        proto_act_imgs = max_dist - proto_dist_imgs
+    else:
+        proto_act_imgs = torch.from_numpy(np.stack([prototype_activation_function_in_numpy(proto_dist_img_j)
+                                                    for proto_dist_img_j in proto_dist_imgs.cpu().numpy()])).to(proto_dist_imgs.device)
+    upsampled_act_imgs = upsample_activation_maps(proto_act_imgs, module.img_size)
+    proto_bounds = find_high_activation_crops(upsampled_act_imgs).cpu().numpy()
+
+    proto_act_imgs = proto_act_imgs.cpu().numpy()
+    upsampled_act_imgs = upsampled_act_imgs.cpu().numpy()
+    locations = global_min_locations[found].cpu().numpy()
+    protoL_rf_info = module.proto_layer_rf_info
+
+    for i, j in enumerate(found.tolist()):
+        img_index, img_class, dist_height_index, dist_width_index = locations[i]
+
+        # get the receptive field boundary of the image patch
+        # that generates the representation
+        rf_prototype_j = compute_rf_prototype(module.img_size, [img_index, dist_height_index, dist_width_index], protoL_rf_info)
+
+        # save the prototype receptive field information
+        proto_rf_boxes[j, 0] = rf_prototype_j[0]
+        proto_rf_boxes[j, 1] = rf_prototype_j[1]
+        proto_rf_boxes[j, 2] = rf_prototype_j[2]
+        proto_rf_boxes[j, 3] = rf_prototype_j[3]
+        proto_rf_boxes[j, 4] = rf_prototype_j[4]
+        if proto_rf_boxes.shape[1] == 6 and img_class != -1:
+            proto_rf_boxes[j, 5] = img_class
+
+        # save the prototype boundary (rectangular boundary of highly activated region)
+        proto_bound_j = proto_bounds[i]
+        proto_bound_boxes[j, 0] = proto_rf_boxes[j, 0]
+        proto_bound_boxes[j, 1] = proto_bound_j[0]
+        proto_bound_boxes[j, 2] = proto_bound_j[1]
+        proto_bound_boxes[j, 3] = proto_bound_j[2]
+        proto_bound_boxes[j, 4] = proto_bound_j[3]
+        if proto_bound_boxes.shape[1] == 6 and img_class != -1:
+            proto_bound_boxes[j, 5] = img_class
+
+        if dir_for_saving_prototypes is not None and artifact_writer is not None:
+            if prototype_self_act_filename_prefix is not None:
+                # save the numpy array of the prototype self activation
+                artifact_writer.submit(np.save,
+                                       os.path.join(dir_for_saving_prototypes,
+                                                    prototype_self_act_filename_prefix + str(j) + '.npy'),
+                                       proto_act_imgs[i])
+            if prototype_img_filename_prefix is not None and artifact_writer.render_images:
+                artifact_writer.submit(save_prototype_images, j, dataset, img_index, upsampled_act_imgs[i],
+                                       rf_prototype_j, proto_bound_j,
+                                       dir_for_saving_prototypes, prototype_img_filename_prefix)
+
+    return proto_rf_boxes, proto_bound_boxes
+
+def save_prototype_images(j, dataset, img_index, upsampled_act_img_j, rf_prototype_j, proto_bound_j,
+                          dir_for_saving_prototypes, prototype_img_filename_prefix):
+    # get the whole image
+    original_img_j = dataset[img_index]['image']
+    if original_img_j.dtype == torch.uint8:
+        original_img_j = original_img_j.float() / 255
+    original_img_j = original_img_j.numpy()
+    original_img_j = np.transpose(original_img_j, (1, 2, 0))
+    original_img_size = original_img_j.shape[0]
+
+    # crop out the receptive field
+    rf_img_j = original_img_j[rf_prototype_j[1]:rf_prototype_j[2],
+                              rf_prototype_j[3]:rf_prototype_j[4], :]
+    # crop out the image patch with high activation as prototype image
+    proto_img_j = original_img_j[proto_bound_j[0]:proto_bound_j[1],
+                                 proto_bound_j[2]:proto_bound_j[3], :]
+
+    # save the whole image containing the prototype as png
+    plt.imsave(os.path.join(dir_for_saving_prototypes,
+                            prototype_img_filename_prefix + '-original' + str(j) + '.png'),
+               original_img_j,
+               vmin=0.0,
+               vmax=1.0)
+    # overlay (upsampled) self activation on original image and save the result
+    rescaled_act_img_j = upsampled_act_img_j - np.amin(upsampled_act_img_j)
+    rescaled_act_img_j = rescaled_act_img_j / np.amax(rescaled_act_img_j)
+    heatmap = cv2.applyColorMap(np.uint8(255*rescaled_act_img_j), cv2.COLORMAP_JET)
+    heatmap = np.float32(heatmap) / 255
+    heatmap = heatmap[...,::-1]
+    overlayed_original_img_j = 0.5 * original_img_j + 0.3 * heatmap
+    plt.imsave(os.path.join(dir_for_saving_prototypes,
+                            prototype_img_filename_prefix + '-original_with_self_act' + str(j) + '.png'),
+               overlayed_original_img_j,
+               vmin=0.0,
+               vmax=1.0)
+
+    # if different from the original (whole) image, save the prototype receptive field as png
+    if rf_img_j.shape[0] != original_img_size or rf_img_j.shape[1] != original_img_size:
+        plt.imsave(os.path.join(dir_for_saving_prototypes,
+                                prototype_img_filename_prefix + '-receptive_field' + str(j) + '.png'),
+                   rf_img_j,
+                   vmin=0.0,
+                   vmax=1.0)
+        overlayed_rf_img_j = overlayed_original_img_j[rf_prototype_j[1]:rf_prototype_j[2],
+                                                      rf_prototype_j[3]:rf_prototype_j[4]]
+        plt.imsave(os.path.join(dir_for_saving_prototypes,
+                                prototype_img_filename_prefix + '-receptive_field_with_self_act' + str(j) + '.png'),
+                   overlayed_rf_img_j,
+                   vmin=0.0,
+                   vmax=1.0)
+
+    # save the prototype image (highly activated region of the whole image)
+    plt.imsave(os.path.join(dir_for_saving_prototypes,
+                            prototype_img_filename_prefix + str(j) + '.png'),
+               proto_img_j,
+               vmin=0.0,
+               vmax=1.0)
@@ -3,11 +3,11 @@ import tomllib
 with open("../model_selection.toml", "rb") as f:
     TOML = tomllib.load(f)
 
-base_architecture = TOML['model_paramas']['base_architecture'] # or 'vgg19' or 'densenet169'
+base_architecture = TOML['model_params']['base_architecture'] # or 'vgg19' or 'densenet169'
 
 # There are 500 test images (10 images per one of 50 classes) of 256x256 resolution
 img_size = 256
-prototype_shape = (500, TOML['model_paramas']['prototype_size'], 1, 1) #the 128 is a prototype size. We tested 256 and 512 as well. 
+prototype_shape = (500, TOML['model_params']['prototype_size'], 1, 1) #the 128 is a prototype size. We tested 256 and 512 as well. 
 num_classes = 50
 prototype_activation_function = 'log'
 add_on_layers_type = 'regular'
@@ -22,7 +22,20 @@ train_dir = data_path
 test_dir = data_path 
 train_push_dir = data_path 
 
-train_batch_size = 80
+# Optional cache written by FunnyBirdsFramework/build_memmap_dataset.py; when set, the loaders read the
+# decoded images from its memory-mapped arrays instead of the PNGs; they are loaded as uint8 and
+# converted to float on the device
+dataset_cache_dir = TOML['paths'].get('dataset_cache_dir')
+
+# Mixed precision / channels-last options, all optional in model_selection.toml
+training = TOML.get('training', {})
+amp = training.get('amp', 'none') # 'none', 'bf16' or 'fp16' (fp16 also enables a grad scaler)
+channels_last = training.get('channels_last', False)
+# Train-time augmentation, applied to whole batches on the device (off by default)
+hflip = training.get('hflip', False)
+color_jitter = training.get('color_jitter', 0.0) # strength of the brightness/contrast/saturation factors
+
+train_batch_size = training.get('train_batch_size', 80)
 test_batch_size = 100
 train_push_batch_size = 75
 
@@ -31,7 +44,7 @@ joint_optimizer_lrs = {'features': 1e-4,
                        'prototype_vectors': 3e-3}
 
 # Interval between decreases of learning rate extended to every 10th epoch 
-joint_lr_step_size = TOML['model_paramas']['joint_lr_step_size']
+joint_lr_step_size = TOML['model_params']['joint_lr_step_size']
 
 warm_optimizer_lrs = {'add_on_layers': 3e-3,
                       'prototype_vectors': 3e-3}
@@ -49,6 +62,22 @@ num_train_epochs = 100
 num_warm_epochs = 5
 
 # Push start postponed to 25th epoch
-push_start = TOML['model_paramas']['push_start']
+push_start = TOML['model_params']['push_start']
 
 push_epochs = [i for i in range(num_train_epochs) if i % 10 == 0]
+
+# Number of checkpoints above 70% test accuracy kept in the model directory, besides the latest one
+checkpoint_top_k = 3
+
+# Epoch interval of the (prototype pair distance) diagnostic logged after train and test
+p_dist_pair_interval = 10
+
+# Prototype images are rendered in background threads after each push; disable to only save the self activations
+render_prototype_images = True
+artifact_writer_workers = 4
+
+# The last layer iterations after each push run on cached prototype distances of the train and test sets
+# (computed once in eval mode) instead of full backbone passes; None keeps the cache in gpu memory,
+# a directory stores it in memory-mapped files
+frozen_feature_cache = True
+frozen_feature_cache_dir = None
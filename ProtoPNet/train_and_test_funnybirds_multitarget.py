@@ -1,62 +1,113 @@
 import time
 import torch
+import torch.nn.functional as F
 
-from helpers import list_of_distances, make_one_hot
+from distributed_funnybirds_multitarget import all_reduce, is_distributed_loader
+from class_index_funnybirds_multitarget import class_part_table, admissible_classes, unpack_admissible_classes
+
+def batch_part_idxs(dataset, params, B, part_names):
+    '''
+    [B, num_parts] part indices of a collated batch of params, -1 for parts the bird does not have
+    '''
+    part_idxs = []
+    for b in range(B):
+        params_single = dataset.get_params_for_single(params, idx=b)
+        part_idxs_single = dataset.single_params_to_part_idxs(params_single)
+        part_idxs.append([part_idxs_single.get(part, -1) for part in part_names])
+    return torch.tensor(part_idxs)
+
+def multi_target_cross_entropy(output, admissible):
+    '''
+    cross entropy averaged over the admissible classes of every sample, then over the batch;
+    samples without any admissible class contribute zero
+    '''
+    log_probs = F.log_softmax(output, dim=1).masked_fill(~admissible, 0)
+    n_admissible = admissible.sum(dim=1).clamp(min=1)
+    return (-log_probs.sum(dim=1) / n_admissible).mean()
+
+class EpochMetrics():
+    '''
+    Running sums of the evaluation statistics, kept on the device so that no batch waits for
+    a host sync; synchronize() reads them back (all-reduced over ranks if requested) once per epoch
+    '''
+    device_names = ('n_correct', 'cross_entropy', 'cluster_cost', 'separation_cost', 'avg_separation_cost')
+
+    def __init__(self, device):
+        self.sums = torch.zeros(len(self.device_names), dtype=torch.float64, device=device)
+        # known on the host without waiting for the device
+        self.n_examples = 0
+        self.n_batches = 0
+
+    def update(self, n_examples, n_correct, cross_entropy, cluster_cost, separation_cost, avg_separation_cost):
+        self.n_examples += n_examples
+        self.n_batches += 1
+        self.sums += torch.stack([value.detach().double() for value in
+                                  (n_correct, cross_entropy, cluster_cost, separation_cost, avg_separation_cost)])
+
+    def synchronize(self, reduce=False):
+        sums = torch.cat([self.sums, self.sums.new_tensor([self.n_examples, self.n_batches])])
+        if reduce:
+            all_reduce(sums)
+        return dict(zip(self.device_names + ('n_examples', 'n_batches'), sums.tolist()))
+
+def mean_prototype_pair_distance(model):
+    '''mean squared distance between all pairs of prototypes, computed on the device'''
+    with torch.no_grad():
+        p = model.module.prototype_vectors.view(model.module.num_prototypes, -1)
+        p_squared = torch.sum(p ** 2, dim=1)
+        p_pair_dist = (p_squared[:, None] + p_squared[None, :] - 2 * p @ p.t()).clamp(min=0)
+        return torch.mean(p_pair_dist).item()
 
 def _train_or_test(model, dataloader, optimizer=None, class_specific=True, use_l1_mask=True,
-                   coefs=None, log=print):
+                   coefs=None, log=print, scaler=None, log_p_dist_pair=True, input_transform=None):
     '''
     model: the multi-gpu model
     dataloader:
     optimizer: if None, will be test evaluation
+    scaler: optional torch.cuda.amp.GradScaler for fp16 training
+    log_p_dist_pair: whether to compute and log the mean prototype pair distance
+    input_transform: optional DeviceTransform applied to every image batch on the device
     '''
     is_train = optimizer is not None
     start = time.time()
-    n_examples = 0
-    n_correct = 0
-    n_batches = 0
-    total_cross_entropy = 0
-    total_cluster_cost = 0
+
+    class_parts, part_names = class_part_table(dataloader.dataset)
+    device = model.module.prototype_vectors.device
+    class_parts = class_parts.to(device)
     # separation cost is meaningful only for class_specific
-    total_separation_cost = 0
-    total_avg_separation_cost = 0
+    metrics = EpochMetrics(device)
 
     for i, samples in enumerate(dataloader):
-        images = samples['image'].cuda(non_blocking=True)
         label = samples['class_idx']
-        target = label.cuda(non_blocking=True)
+        target = label.to(device, non_blocking=True)
 
         # torch.enable_grad() has no effect outside of no_grad()
         grad_req = torch.enable_grad() if is_train else torch.no_grad()
         with grad_req:
-            # nn.Module has implemented __call__() function
-            # so no need to call .forward
-            output, min_distances = model(input)
+            if 'min_distances' in samples:
+                # frozen features (FrozenFeatureLoader): only the last layer is evaluated
+                min_distances = samples['min_distances']
+                output = model.module.last_layer(model.module.distance_2_similarity(min_distances))
+            else:
+                images = samples['image'].to(device, non_blocking=True)
+                if input_transform is not None:
+                    images = input_transform(images, train=is_train)
+                # nn.Module has implemented __call__() function
+                # so no need to call .forward
+                output, min_distances = model(images)
 
 
             # compute loss -> based on FunnyBird's training.py
-            B,_,_,_ = images.shape
-            params = samples['params']
-            cross_entropy = 0.
-            for b in range(B):
-                params_single = dataloader.dataset.get_params_for_single(params, idx=b)
-                part_idxs = dataloader.dataset.single_params_to_part_idxs(params_single)    
-                target_classes = list(range(len(dataloader.dataset.classes)))
-                for part in part_idxs.keys():
-                    part_idx = part_idxs[part]
-                    if part_idx == -1:
-                        continue
-                    for class_idx in range(len(dataloader.dataset.classes)):
-                        class_spec = dataloader.dataset.classes[class_idx]
-                        if part_idx != class_spec['parts'][part]:
-                            try:
-                                target_classes.remove(class_idx)
-                            except ValueError:
-                                do_nothin = 'do_nothing'
-
-                for target_class in target_classes:
-                    target_class_tensor = torch.tensor([target_class]).cuda(non_blocking=True)
-                    cross_entropy += torch.nn.functional.cross_entropy(output[b].unsqueeze(0), target_class_tensor) * 1/len(target_classes) * 1/B
+            # every class matching the bird's parts is a target, weighted equally
+            if 'admissible' in samples:
+                admissible = samples['admissible']
+            elif 'admissible_classes' in samples:
+                admissible = unpack_admissible_classes(samples['admissible_classes'].to(device, non_blocking=True),
+                                                       output.shape[1])
+            else:
+                part_idxs = batch_part_idxs(dataloader.dataset, samples['params'], label.shape[0], part_names)
+                admissible = admissible_classes(part_idxs.to(device, non_blocking=True), class_parts)
+            cross_entropy = multi_target_cross_entropy(output, admissible)
 
             if class_specific:
                 max_dist = (model.module.prototype_shape[1]
@@ -65,7 +116,7 @@ def _train_or_test(model, dataloader, optimizer=None, class_specific=True, use_l
 
                 # prototypes_of_correct_class is a tensor of shape batch_size * num_prototypes
                 # calculate cluster cost
-                prototypes_of_correct_class = torch.t(model.module.prototype_class_identity[:,label]).cuda()
+                prototypes_of_correct_class = torch.t(model.module.prototype_class_identity[:,label]).to(device)
                 inverted_distances, _ = torch.max((max_dist - min_distances) * prototypes_of_correct_class, dim=1)
                 cluster_cost = torch.mean(max_dist - inverted_distances)
 
@@ -81,7 +132,7 @@ def _train_or_test(model, dataloader, optimizer=None, class_specific=True, use_l
                 avg_separation_cost = torch.mean(avg_separation_cost)
                 
                 if use_l1_mask:
-                    l1_mask = 1 - torch.t(model.module.prototype_class_identity).cuda()
+                    l1_mask = 1 - torch.t(model.module.prototype_class_identity).to(device)
                     l1 = (model.module.last_layer.weight * l1_mask).norm(p=1)
                 else:
                     l1 = model.module.last_layer.weight.norm(p=1) 
@@ -93,14 +144,12 @@ def _train_or_test(model, dataloader, optimizer=None, class_specific=True, use_l
 
             # evaluation statistics
             _, predicted = torch.max(output.data, 1)
-            n_examples += target.size(0)
-            n_correct += (predicted == target).sum().item()
-
-            n_batches += 1
-            total_cross_entropy += cross_entropy.item()
-            total_cluster_cost += cluster_cost.item()
-            total_separation_cost += separation_cost.item()
-            total_avg_separation_cost += avg_separation_cost.item()
+            metrics.update(n_examples=target.size(0),
+                           n_correct=(predicted == target).sum(),
+                           cross_entropy=cross_entropy,
+                           cluster_cost=cluster_cost,
+                           separation_cost=separation_cost,
+                           avg_separation_cost=avg_separation_cost)
 
         # compute gradient and do SGD step
         if is_train:
@@ -120,47 +169,58 @@ def _train_or_test(model, dataloader, optimizer=None, class_specific=True, use_l
                 else:
                     loss = cross_entropy + 0.8 * cluster_cost + 1e-4 * l1
             optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            if scaler is not None:
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                loss.backward()
+                optimizer.step()
 
-        del images
         del target
         del output
         del predicted
         del min_distances
 
+    # the only host sync of the epoch; every rank has only seen its shard of a distributed loader
+    totals = metrics.synchronize(reduce=is_distributed_loader(dataloader))
+    n_examples = totals['n_examples']
+    n_correct = totals['n_correct']
+    n_batches = totals['n_batches']
+
     end = time.time()
 
     log('\ttime: \t{0}'.format(end -  start))
-    log('\tcross ent: \t{0}'.format(total_cross_entropy / n_batches))
-    log('\tcluster: \t{0}'.format(total_cluster_cost / n_batches))
+    log('\tcross ent: \t{0}'.format(totals['cross_entropy'] / n_batches))
+    log('\tcluster: \t{0}'.format(totals['cluster_cost'] / n_batches))
     if class_specific:
-        log('\tseparation:\t{0}'.format(total_separation_cost / n_batches))
-        log('\tavg separation:\t{0}'.format(total_avg_separation_cost / n_batches))
+        log('\tseparation:\t{0}'.format(totals['separation_cost'] / n_batches))
+        log('\tavg separation:\t{0}'.format(totals['avg_separation_cost'] / n_batches))
     log('\taccu: \t\t{0}%'.format(n_correct / n_examples * 100))
     log('\tl1: \t\t{0}'.format(model.module.last_layer.weight.norm(p=1).item()))
-    p = model.module.prototype_vectors.view(model.module.num_prototypes, -1).cpu()
-    with torch.no_grad():
-        p_avg_pair_dist = torch.mean(list_of_distances(p, p))
-    log('\tp dist pair: \t{0}'.format(p_avg_pair_dist.item()))
+    if log_p_dist_pair:
+        log('\tp dist pair: \t{0}'.format(mean_prototype_pair_distance(model)))
 
     return n_correct / n_examples
 
 
-def train(model, dataloader, optimizer, class_specific=False, coefs=None, log=print):
+def train(model, dataloader, optimizer, class_specific=False, coefs=None, log=print, scaler=None,
+          log_p_dist_pair=True, input_transform=None):
     assert(optimizer is not None)
     
     log('\ttrain')
     model.train()
     return _train_or_test(model=model, dataloader=dataloader, optimizer=optimizer,
-                          class_specific=class_specific, coefs=coefs, log=log)
+                          class_specific=class_specific, coefs=coefs, log=log, scaler=scaler,
+                          log_p_dist_pair=log_p_dist_pair, input_transform=input_transform)
 
 
-def test(model, dataloader, class_specific=False, log=print):
+def test(model, dataloader, class_specific=False, log=print, log_p_dist_pair=True, input_transform=None):
     log('\ttest')
     model.eval()
     return _train_or_test(model=model, dataloader=dataloader, optimizer=None,
-                          class_specific=class_specific, log=log)
+                          class_specific=class_specific, log=log, log_p_dist_pair=log_p_dist_pair,
+                          input_transform=input_transform)
 
 
 def last_only(model, log=print):
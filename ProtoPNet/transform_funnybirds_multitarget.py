@@ -0,0 +1,59 @@
+import torch
+
+# ITU-R 601 luma weights, as in torchvision's rgb_to_grayscale
+LUMA = (0.299, 0.587, 0.114)
+
+
+class DeviceTransform():
+    '''
+    Input stage applied to whole batches after they are moved to the device, instead of per sample
+    in the DataLoader workers: uint8 images (FunnyBirdsMemmap with uint8=True) are converted to float
+    in [0,1], training batches are optionally flipped and colour jittered, and the result is
+    normalized with mean and std if they are given.
+    Float batches in [0,1] are accepted as well, so it can replace preprocess_input_function in push
+    '''
+    def __init__(self, mean=None, std=None, hflip=False, color_jitter=0.0):
+        '''
+        hflip: flip every training image horizontally with probability 0.5
+        color_jitter: strength s of the random brightness, contrast and saturation factors,
+                      drawn per training image from [1-s, 1+s]; 0 disables the jitter
+        '''
+        self.mean = mean
+        self.std = std
+        self.hflip = hflip
+        self.color_jitter = color_jitter
+        # device -> ([1,3,1,1] mean, [1,3,1,1] std)
+        self.statistics = {}
+
+    def __call__(self, images, train=False):
+        if images.dtype == torch.uint8:
+            images = images.float().div_(255)
+        if train and self.hflip:
+            flip = torch.rand(images.shape[0], device=images.device) < 0.5
+            images = torch.where(flip[:, None, None, None], images.flip(3), images)
+        if train and self.color_jitter > 0:
+            images = self.jitter(images)
+        if self.mean is not None:
+            mean, std = self.device_statistics(images.device)
+            images = (images - mean) / std
+        return images
+
+    def jitter(self, images):
+        B = images.shape[0]
+        luma = images.new_tensor(LUMA).view(1, 3, 1, 1)
+
+        def factors():
+            return torch.empty(B, 1, 1, 1, device=images.device).uniform_(1 - self.color_jitter, 1 + self.color_jitter)
+
+        images = (images * factors()).clamp(0, 1)
+        # contrast blends with the mean gray level of the image, saturation with the gray image
+        gray = (images * luma).sum(dim=1, keepdim=True)
+        images = torch.lerp(gray.mean(dim=(2, 3), keepdim=True), images, factors()).clamp(0, 1)
+        gray = (images * luma).sum(dim=1, keepdim=True)
+        return torch.lerp(gray, images, factors()).clamp(0, 1)
+
+    def device_statistics(self, device):
+        if device not in self.statistics:
+            self.statistics[device] = (torch.tensor(self.mean, device=device).view(1, -1, 1, 1),
+                                       torch.tensor(self.std, device=device).view(1, -1, 1, 1))
+        return self.statistics[device]